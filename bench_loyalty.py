@@ -0,0 +1,465 @@
+"""Benchmark of the loyalty evaluation of OrderLoyaltyProgram.
+
+Loads the billing_* / users_* schema of ``mydb_backup.sql`` into the database of the given Django
+settings (a local Postgres, or a SQLite file as stand-in), generates a synthetic catalog and carts,
+then times ``get_programs``, ``_order_try_apply_coupon``, ``_order_try_apply_reward`` and
+``_order_apply_reward``. Query counts and latency percentiles are written as JSON so runs on
+different commits can be compared::
+
+    python bench_loyalty.py --settings my_cloudfly.settings.bench --load-schema \\
+        --programs 50 --conditions 3 --rewards 2 --cart-sizes 1,5,20,50 --output bench_output.json
+
+The settings must point to a dedicated benchmark database. The schema (with ``--load-schema``)
+and the synthetic data are created inside one transaction that is rolled back at the end, so
+the same database can be reused run after run; pass ``--load-schema`` on every run when the
+tables do not exist yet.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+SCHEMA_TABLE_PATTERN = re.compile(r'^(billing_|users_|core_currency$)')
+TABLE_REFERENCE = re.compile(r'public\.([a-z0-9_]+)')
+
+SQLITE_TYPES = (
+    ('character varying', 'TEXT'),
+    ('text', 'TEXT'),
+    ('jsonb', 'TEXT'),
+    ('uuid', 'TEXT'),
+    ('timestamp with time zone', 'DATETIME'),
+    ('date', 'DATE'),
+    ('numeric', 'DECIMAL'),
+    ('double precision', 'REAL'),
+    ('boolean', 'BOOL'),
+    ('smallint', 'INTEGER'),
+    ('bigint', 'INTEGER'),
+    ('integer', 'INTEGER'),
+)
+
+
+class SchemaTable:
+    """Columns of one table of the dump, used to create it on SQLite and to fill NOT NULL columns."""
+
+    def __init__(self, name):
+        self.name = name
+        # [(name, type, not_null)]
+        self.columns = list()
+        self.primary_key = None
+        self.unique = list()
+
+    def column_type(self, column):
+        for name, column_type, _not_null in self.columns:
+            if name == column:
+                return column_type
+        return None
+
+    def default(self, column_type):
+        if column_type.startswith(('character varying', 'text')):
+            return ''
+        if column_type == 'jsonb':
+            return '{}'
+        if column_type == 'boolean':
+            return False
+        if column_type.startswith('timestamp'):
+            return datetime.datetime.now(datetime.timezone.utc)
+        if column_type == 'date':
+            return datetime.date.today()
+        return 0
+
+    def sqlite_create(self):
+        definitions = []
+        for name, column_type, not_null in self.columns:
+            sqlite_type = next(
+                (mapped for prefix, mapped in SQLITE_TYPES if column_type.startswith(prefix)), 'TEXT'
+            )
+            definition = '"%s" %s' % (name, sqlite_type)
+            if name == self.primary_key:
+                definition += ' PRIMARY KEY'
+            elif not_null:
+                definition += ' NOT NULL'
+            definitions.append(definition)
+        statements = ['CREATE TABLE "%s" (%s)' % (self.name, ', '.join(definitions))]
+        for index, columns in enumerate(self.unique):
+            statements.append('CREATE UNIQUE INDEX "%s_uniq_%s" ON "%s" (%s)' % (
+                self.name, index, self.name, ', '.join('"%s"' % column for column in columns)
+            ))
+        return statements
+
+
+def iter_dump_statements(path):
+    """SQL statements of a pg_dump file, without comments and COPY data."""
+    statement = []
+    in_copy = False
+    with open(path) as f:
+        for line in f:
+            if in_copy:
+                if line.rstrip('\n') == '\\.':
+                    in_copy = False
+                continue
+            if line.startswith('COPY '):
+                in_copy = True
+                continue
+            if not statement and (line.startswith('--') or not line.strip()):
+                continue
+            statement.append(line)
+            if line.rstrip().endswith(';'):
+                yield ''.join(statement).strip()
+                statement = []
+
+
+def load_dump_schema(path):
+    """Parse the billing/users tables of the dump.
+
+    Returns ``(tables, statements)``: the parsed :class:`SchemaTable` by name and the Postgres
+    statements creating them (tables, sequences, defaults, primary/unique keys and indexes,
+    foreign keys are left out since the other apps are not loaded).
+    """
+    tables = dict()
+    statements = []
+    for statement in iter_dump_statements(path):
+        referenced = TABLE_REFERENCE.findall(statement)
+        if not referenced or not SCHEMA_TABLE_PATTERN.match(referenced[0]):
+            continue
+        if ' OWNER TO ' in statement or 'FOREIGN KEY' in statement or statement.startswith('SELECT '):
+            continue
+        table_name = referenced[0]
+        if statement.startswith('CREATE TABLE'):
+            table = tables[table_name] = SchemaTable(table_name)
+            body = statement[statement.index('(') + 1:statement.rindex(')')]
+            for line in body.split('\n'):
+                line = line.strip().rstrip(',')
+                if not line or line.startswith('CONSTRAINT'):
+                    continue
+                match = re.match(r'"?([a-z0-9_]+)"? (.+?)( NOT NULL)?$', line)
+                table.columns.append((match.group(1), match.group(2), bool(match.group(3))))
+        elif statement.startswith('ALTER TABLE ONLY') and 'PRIMARY KEY' in statement:
+            tables[table_name].primary_key = re.search(r'PRIMARY KEY \(([^)]+)\)', statement).group(1)
+        elif statement.startswith('ALTER TABLE ONLY') and ' UNIQUE ' in statement:
+            columns = re.search(r'UNIQUE \(([^)]+)\)', statement).group(1)
+            tables[table_name].unique.append([column.strip().strip('"') for column in columns.split(',')])
+        statements.append(statement)
+    return tables, statements
+
+
+def create_schema(connection, tables, statements):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            for statement in statements:
+                cursor.execute(statement)
+            return
+        for table in tables.values():
+            for statement in table.sqlite_create():
+                cursor.execute(statement)
+        for statement in statements:
+            if not statement.startswith(('CREATE INDEX', 'CREATE UNIQUE INDEX')) or '_like ' in statement:
+                continue
+            statement = re.sub(r'public\.', '', statement)
+            statement = re.sub(r' USING btree', '', statement)
+            cursor.execute(statement.rstrip(';'))
+
+
+class SyntheticData:
+    """Insert rows with raw SQL, filling every NOT NULL column the benchmark does not care about."""
+
+    def __init__(self, connection, tables, seed=0):
+        self.connection = connection
+        self.tables = tables
+        self.random = random.Random(seed)
+        self._ids = dict()
+
+    def next_id(self, table):
+        if table not in self._ids:
+            # tiếp nối dữ liệu có sẵn trong database thay vì bắt đầu lại từ 1
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT MAX("%s") FROM "%s"' % (self.tables[table].primary_key, table))
+                self._ids[table] = cursor.fetchone()[0] or 0
+        self._ids[table] += 1
+        return self._ids[table]
+
+    def exists(self, table_name, **values):
+        columns = list(values)
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM "%s" WHERE %s' % (
+                table_name, ' AND '.join('"%s" = %%s' % column for column in columns),
+            ), [values[column] for column in columns])
+            return cursor.fetchone() is not None
+
+    def insert(self, table_name, **values):
+        table = self.tables[table_name]
+        if table.primary_key and table.primary_key not in values:
+            if table.column_type(table.primary_key).startswith('character varying'):
+                values[table.primary_key] = str(uuid.uuid4())
+            else:
+                values[table.primary_key] = self.next_id(table_name)
+        for name, column_type, not_null in table.columns:
+            if not_null and name not in values:
+                values[name] = table.default(column_type)
+        columns = list(values)
+        with self.connection.cursor() as cursor:
+            cursor.execute('INSERT INTO "%s" (%s) VALUES (%s)' % (
+                table_name,
+                ', '.join('"%s"' % column for column in columns),
+                ', '.join(['%s'] * len(columns)),
+            ), [values[column] for column in columns])
+        return values.get(table.primary_key)
+
+    def reset_sequences(self):
+        if self.connection.vendor != 'postgresql':
+            return
+        with self.connection.cursor() as cursor:
+            for table_name, last_id in self._ids.items():
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence(%s, %s), %s)",
+                    ['public.%s' % table_name, self.tables[table_name].primary_key, last_id],
+                )
+
+
+def generate(data, args, models):
+    """Create the synthetic catalog and one cart per cart size, returns the ids the benchmark uses."""
+    RewardProgram, ProgramTypes, OrderItemTypes = models
+    now = datetime.datetime.now(datetime.timezone.utc)
+    currency = 'VND'
+    if not data.exists('core_currency', code=currency):
+        data.insert('core_currency', code=currency, rate=1, is_default=True)
+    user_id = data.insert('users_user', username='bench', email='bench@example.com', is_active=True, date_joined=now)
+    client_id = data.insert('users_client', user_id=user_id, status='active', created_at=now, currency_id=currency)
+    data.insert('users_usertoclient', client_id=client_id, user_id=user_id, default=True)
+
+    group_id = data.insert('billing_productgroup', name='bench', visible=True)
+    products = []
+    for index in range(args.products):
+        product_type = 'instance' if index % 2 == 0 else 'other'
+        product_id = data.insert(
+            'billing_product', name='product %s' % index, code='bench-%s' % index,
+            product_type=product_type, status='active', group_id=group_id,
+        )
+        cycles = [
+            data.insert(
+                'billing_productcycle', product_id=product_id, cycle=cycle, cycle_multiplier=multiplier,
+                fixed_price=100000 * multiplier, status='active', currency_id=currency,
+            )
+            for cycle, multiplier in (('month', 1), ('month', 3), ('year', 1))
+        ]
+        products.append((product_id, product_type, cycles))
+
+    codes = []
+    rewards = []
+    for index in range(args.programs):
+        program_id = data.insert(
+            'billing_loyaltyprogram', name='program %s' % index, program_type=ProgramTypes.promotion,
+            priority=index, applies_on='current', start_time=now - datetime.timedelta(days=1),
+            limit_usage=data.random.random() < args.limited_ratio, max_usage=1000, is_active=True,
+            created_at=now, updated_at=now, currency_id=currency,
+        )
+        program_products = data.random.sample(products, min(len(products), args.products_per_program))
+        for condition_index in range(args.conditions):
+            condition_id = data.insert(
+                'billing_programcondition', name='condition %s' % condition_index, active=True,
+                attribute='vcpus' if condition_index % 2 else None, operator='>=',
+                value=str(condition_index + 1), reward_point_amount=1, reward_point_mode='order',
+                mode='auto', minimum_amount=0, include_tax=False, program_id=program_id,
+            )
+            for product_id, _product_type, cycles in program_products:
+                data.insert('billing_programcondition_products', programcondition_id=condition_id, product_id=product_id)
+                data.insert('billing_programcondition_product_cycles', programcondition_id=condition_id, productcycle_id=cycles[0])
+        for reward_index in range(args.rewards):
+            rewards.append(data.insert(
+                'billing_rewardprogram', description='reward %s' % reward_index, active=True,
+                reward_type=RewardProgram.DISCOUNT, discount=5 * (reward_index + 1), discount_mode='percent',
+                discount_applicability=RewardProgram.APPLY_ORDER, program_id=program_id, required_point=0,
+            ))
+        if data.random.random() < args.code_ratio:
+            code = 'BENCH%05d' % index
+            data.insert(
+                'billing_loyaltycard', code=code, points=0, use_count=0, active=True, created_at=now,
+                program_id=program_id, partner_id=user_id if index % 2 else None,
+            )
+            codes.append(code)
+
+    orders = dict()
+    for cart_size in args.cart_sizes:
+        order_id = data.insert(
+            'billing_order', order_date=now, status='pending', metadata='{}', client_id=client_id,
+            currency_id=currency, created_at=now, updated_at=now, user_id=user_id,
+        )
+        for index in range(cart_size):
+            product_id, product_type, cycles = data.random.choice(products)
+            plugin_data = {}
+            if product_type == 'instance':
+                plugin_data = {
+                    'vcpus': data.random.choice([1, 2, 4, 8]), 'ram': data.random.choice([2048, 4096, 8192]),
+                    'disk': 40, 'region_name': data.random.choice(['HN', 'HCM']), 'flavor_name': 'bench',
+                }
+            data.insert(
+                'billing_orderitem', name='item %s' % index, item_type=OrderItemTypes.service, quantity=1,
+                setup_fee=0, fixed_price=100000, total=100000, plugin_data=json.dumps(plugin_data),
+                cycle_id=cycles[0], order_id=order_id, product_id=product_id, discount=0,
+                created_at=now, updated_at=now,
+            )
+        orders[cart_size] = order_id
+    data.reset_sequences()
+    return dict(orders=orders, codes=codes, rewards=rewards)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(durations, queries):
+    return {
+        'latency_ms': {
+            'mean': statistics.mean(durations) * 1000,
+            'p50': percentile(durations, 0.5) * 1000,
+            'p90': percentile(durations, 0.9) * 1000,
+            'p99': percentile(durations, 0.99) * 1000,
+        },
+        'queries': {'mean': statistics.mean(queries), 'min': min(queries), 'max': max(queries)},
+    }
+
+
+def run_benchmark(args, ids, loyalty):
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from my_cloudfly.billing.models import Order
+    from my_cloudfly.billing.models.reward_and_loyalty import RewardProgram
+
+    def fresh(order_id):
+        return loyalty.OrderLoyaltyProgram(Order.objects.get(pk=order_id))
+
+    def prepare_apply_reward(order_id):
+        evaluator = fresh(order_id)
+        evaluator.get_active_programs(code=None, program_type=loyalty.ProgramTypes.promotion)
+        # evaluate_programs chưa có trên các commit cũ
+        evaluate = getattr(evaluator, 'evaluate_programs', evaluator._order_program_check_compute_points)
+        evaluator._apply_program(evaluate())
+        for coupon, rewards in evaluator._get_claimable_rewards().items():
+            return lambda: evaluator._order_apply_reward(rewards[0], coupon)
+        return None
+
+    code = ids['codes'][0] if ids['codes'] else None
+    reward = RewardProgram.objects.filter(id__in=ids['rewards']).first()
+    operations = {
+        'get_programs': lambda order_id: fresh(order_id).get_programs,
+        'order_try_apply_coupon': lambda order_id: code and (lambda: fresh(order_id)._order_try_apply_coupon(code)),
+        'order_try_apply_reward': lambda order_id: reward and (lambda: fresh(order_id)._order_try_apply_reward(reward)),
+        'order_apply_reward': prepare_apply_reward,
+    }
+
+    results = []
+    # module trước khi có catalog snapshot (--module trỏ tới code gốc) không có hai hàm này
+    catalog_build = None
+    if hasattr(loyalty, 'reset_loyalty_catalog') and hasattr(loyalty, 'get_loyalty_catalog'):
+        loyalty.reset_loyalty_catalog()
+        start = time.perf_counter()
+        loyalty.get_loyalty_catalog()
+        catalog_build = time.perf_counter() - start
+    for name, prepare in operations.items():
+        for cart_size, order_id in sorted(ids['orders'].items()):
+            durations = []
+            queries = []
+            for _iteration in range(args.warmup + args.iterations):
+                with transaction.atomic():
+                    operation = prepare(order_id)
+                    if not operation:
+                        transaction.set_rollback(True)
+                        break
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        operation()
+                        duration = time.perf_counter() - start
+                    # chạy lại được trên cùng dữ liệu
+                    transaction.set_rollback(True)
+                if _iteration >= args.warmup:
+                    durations.append(duration)
+                    queries.append(len(captured.captured_queries))
+            if durations:
+                results.append(dict(operation=name, cart_size=cart_size, iterations=len(durations),
+                                    **summarize(durations, queries)))
+    return dict(catalog_build_ms=catalog_build * 1000 if catalog_build is not None else None, results=results)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--settings', default=os.environ.get('DJANGO_SETTINGS_MODULE'),
+                        help='Django settings of the benchmark database')
+    parser.add_argument('--module', default='demo3', help='module defining OrderLoyaltyProgram')
+    parser.add_argument('--schema', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mydb_backup.sql'))
+    parser.add_argument('--load-schema', action='store_true', help='create the tables of the dump first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--programs', type=int, default=50)
+    parser.add_argument('--conditions', type=int, default=3, help='conditions per program')
+    parser.add_argument('--rewards', type=int, default=2, help='rewards per program')
+    parser.add_argument('--products-per-program', type=int, default=5)
+    parser.add_argument('--limited-ratio', type=float, default=0.3, help='share of programs with limited usage')
+    parser.add_argument('--code-ratio', type=float, default=0.3, help='share of programs gated by a card code')
+    parser.add_argument('--cart-sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[1, 5, 20, 50])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', help='JSON file, stdout when omitted')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.settings:
+        sys.exit('--settings or DJANGO_SETTINGS_MODULE is required')
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+
+    import django
+    django.setup()
+    from django.db import connection, transaction
+    from my_cloudfly.billing.models.reward_and_loyalty import RewardProgram, ProgramTypes
+    from my_cloudfly.billing.models.types import OrderItemTypes
+    loyalty = importlib.import_module(args.module)
+
+    tables, statements = load_dump_schema(args.schema)
+    # schema (với --load-schema) và dữ liệu tổng hợp bị rollback sau mỗi lần chạy,
+    # để các lần chạy trên những commit khác nhau bắt đầu từ cùng một database
+    with transaction.atomic():
+        if args.load_schema:
+            create_schema(connection, tables, statements)
+        ids = generate(SyntheticData(connection, tables, seed=args.seed), args,
+                       (RewardProgram, ProgramTypes, OrderItemTypes))
+        try:
+            results = run_benchmark(args, ids, loyalty)
+        finally:
+            transaction.set_rollback(True)
+
+    report = dict(
+        revision=git_revision(),
+        vendor=connection.vendor,
+        params={key: value for key, value in vars(args).items() if key not in ('settings', 'output')},
+        **results,
+    )
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
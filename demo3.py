@@ -1,17 +1,36 @@
+import asyncio
+import bisect
 import decimal
-from itertools import chain
-from typing import List, Tuple
+import fcntl
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
 from decimal import Decimal
-from django.db.models import QuerySet
-from django.utils.translation import gettext_lazy as _
+from django.db.models import Case, Count, F, Max, Min, Prefetch, QuerySet, Sum, Value, When, prefetch_related_objects
+from django.utils.translation import get_language, gettext_lazy as _
 from rest_framework.exceptions import APIException
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.functional import Promise, cached_property
 from my_cloudfly.billing.api.loyalty_program.serializers import RewardProgramClientSerializer
 from my_cloudfly.billing.models import Order, LoyaltyProgram, OrderItem, ConfigurableOptionCycle
 from my_cloudfly.billing.models.order_reward_and_loyalty import OrderPointReward
-from my_cloudfly.billing.models.reward_and_loyalty import ProgramCondition, RewardProgram, ProgramTypes
+from my_cloudfly.billing.models.reward_and_loyalty import LoyaltyCard, ProgramCondition, RewardProgram, ProgramTypes
 from my_cloudfly.billing.models.types import OrderItemTypes
 from my_cloudfly.billing.utils.cart import update_order_items
 from my_cloudfly.osbilling.price_simulator import PriceSimulatorUtils, PriceSimulator
@@ -20,44 +39,1217 @@ from my_cloudfly.core.utils import cdecimal
 
 ReosurceTypes = PriceSimulator.ResourceTypes
 
+logger = logging.getLogger(__name__)
+
+# Snapshot được build lại khi generation thay đổi; LOYALTY_CATALOG_MAX_AGE chỉ là lưới an toàn
+LOYALTY_CATALOG_MAX_AGE = getattr(settings, 'LOYALTY_CATALOG_MAX_AGE', 3600)
+# 'file' dùng chung giữa các worker trên cùng máy, 'cache' dùng chung qua cache backend (redis, database)
+LOYALTY_CATALOG_GENERATION_BACKEND = getattr(settings, 'LOYALTY_CATALOG_GENERATION_BACKEND', 'file')
+LOYALTY_CATALOG_GENERATION_FILE = getattr(
+    settings, 'LOYALTY_CATALOG_GENERATION_FILE',
+    os.path.join(tempfile.gettempdir(), 'loyalty_catalog.generation')
+)
+LOYALTY_CATALOG_GENERATION_CACHE_KEY = 'billing:loyalty_catalog:generation'
+PRICING_CATALOG_GENERATION_FILE = getattr(
+    settings, 'PRICING_CATALOG_GENERATION_FILE',
+    os.path.join(tempfile.gettempdir(), 'pricing_catalog.generation')
+)
+PRICING_CATALOG_GENERATION_CACHE_KEY = 'billing:pricing_catalog:generation'
+# Số cấu hình instance tối đa được giữ trong cache traits của mỗi worker
+LOYALTY_TRAITS_CACHE_SIZE = getattr(settings, 'LOYALTY_TRAITS_CACHE_SIZE', 1024)
+# Lưới an toàn khi thay đổi giá không đi qua signal (update() hàng loạt, SQL trực tiếp)
+LOYALTY_TRAITS_CACHE_MAX_AGE = getattr(settings, 'LOYALTY_TRAITS_CACHE_MAX_AGE', LOYALTY_CATALOG_MAX_AGE)
+# Model giá và flavor mà PriceSimulatorUtils đọc, thay đổi sẽ bump pricing generation
+LOYALTY_PRICING_MODELS = getattr(settings, 'LOYALTY_PRICING_MODELS', (
+    'billing.ProductCycle',
+    'billing.ConfigurableOptionCycle',
+    'billing.ProductExtraPrice',
+    'billing.PricingPlan',
+    'billing.PricingRule',
+    'billing.PricingRuleCondition',
+    'billing.PricingRuleModifier',
+    'openstack.OpenstackInstanceFlavor',
+    'openstack.FlavorProperty',
+    'openstack.FlavorGroup',
+))
+# Thời gian giữ kết quả của một request apply theo idempotency key
+LOYALTY_APPLY_IDEMPOTENCY_TIMEOUT = getattr(settings, 'LOYALTY_APPLY_IDEMPOTENCY_TIMEOUT', 10 * 60)
+LOYALTY_APPLY_IDEMPOTENCY_PREFIX = 'billing:loyalty_apply'
+# Marker của request đang xử lý, hết hạn sớm nếu worker chết trước khi ghi kết quả
+LOYALTY_APPLY_PENDING = 'pending'
+LOYALTY_APPLY_PENDING_TIMEOUT = getattr(settings, 'LOYALTY_APPLY_PENDING_TIMEOUT', 30)
+# Số reward mặc định trong một trang của OrderLoyaltyProgram.list_programs
+LOYALTY_REWARD_PAGE_SIZE = getattr(settings, 'LOYALTY_REWARD_PAGE_SIZE', 50)
+# Số order được nạp và ghi lại trong một lượt của BatchOrderEvaluator
+LOYALTY_BATCH_CHUNK_SIZE = getattr(settings, 'LOYALTY_BATCH_CHUNK_SIZE', 200)
+
+
+class FileCatalogGeneration:
+    """Catalog generation counter stored in a local file shared by every worker of the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def current(self) -> int:
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self) -> int:
+        # lock trên file riêng, file generation được thay thế nguyên khối bằng os.replace
+        # nên current() không bao giờ đọc được file rỗng
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                generation = self.current() + 1
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(str(generation))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return generation
+
+
+class CacheCatalogGeneration:
+    """Catalog generation counter stored in the shared Django cache (redis, database cache, ...)."""
+
+    def __init__(self, key: str):
+        self.key = key
+
+    def current(self) -> int:
+        return cache.get(self.key, 0)
+
+    def bump(self) -> int:
+        cache.add(self.key, 0, timeout=None)
+        try:
+            return cache.incr(self.key)
+        except ValueError:
+            # key bị evict giữa add và incr
+            cache.set(self.key, 1, timeout=None)
+            return 1
+
+
+if LOYALTY_CATALOG_GENERATION_BACKEND == 'cache':
+    catalog_generation = CacheCatalogGeneration(LOYALTY_CATALOG_GENERATION_CACHE_KEY)
+    pricing_generation = CacheCatalogGeneration(PRICING_CATALOG_GENERATION_CACHE_KEY)
+else:
+    catalog_generation = FileCatalogGeneration(LOYALTY_CATALOG_GENERATION_FILE)
+    pricing_generation = FileCatalogGeneration(PRICING_CATALOG_GENERATION_FILE)
+
+
+def invalidate_pricing_catalog():
+    """Bump the pricing catalog version once the current transaction commits.
+
+    Called on save and delete of ``LOYALTY_PRICING_MODELS``; call it directly after bulk
+    updates of prices or flavors so the cached instance traits of every worker are recomputed.
+    """
+    transaction.on_commit(pricing_generation.bump)
+
+
+def _on_pricing_model_changed(sender, instance, **kwargs):
+    invalidate_pricing_catalog()
+
+
+def connect_pricing_catalog_signals():
+    """Invalidate the cached instance traits when a price or flavor model changes.
+
+    Like :func:`connect_loyalty_catalog_signals`, call it from ``AppConfig.ready()``. Models are
+    referenced lazily by label, a label of an app that is not installed never fires.
+    """
+    for label in LOYALTY_PRICING_MODELS:
+        post_save.connect(
+            _on_pricing_model_changed, sender=label,
+            dispatch_uid='pricing_catalog_save_%s' % label.lower(),
+        )
+        post_delete.connect(
+            _on_pricing_model_changed, sender=label,
+            dispatch_uid='pricing_catalog_delete_%s' % label.lower(),
+        )
+
+
+connect_pricing_catalog_signals()
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with hit/miss/eviction counters.
+
+    With ``max_age`` (seconds) entries older than that are recomputed on their next read.
+    """
+
+    def __init__(self, maxsize: int, max_age: float = None):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # {key: (value, stored_at)}
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                value, stored_at = self._data[key]
+                if self.max_age is None or time.monotonic() - stored_at <= self.max_age:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class StageMetrics:
+    """Wall time, SQL queries and rows of one instrumented stage."""
+    __slots__ = ('stage', 'labels', 'duration', 'queries', 'rows')
+
+    def __init__(self, stage: str, labels: dict, duration: float, queries: int, rows: int):
+        self.stage = stage
+        self.labels = labels
+        self.duration = duration
+        self.queries = queries
+        self.rows = rows
+
+    def as_dict(self) -> dict:
+        return dict(
+            stage=self.stage, duration=self.duration, queries=self.queries, rows=self.rows, **self.labels
+        )
+
+
+class _QueryCounter:
+    """``connection.execute_wrapper`` counting queries and the rows they returned or touched."""
+    __slots__ = ('queries', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.queries += 1
+        rowcount = getattr(context.get('cursor'), 'rowcount', -1)
+        if rowcount and rowcount > 0:
+            self.rows += rowcount
+        return result
+
+
+class LoggingSink:
+    """Log every stage at DEBUG level, stages slower than ``slow_threshold`` seconds at WARNING."""
+
+    def __init__(self, slow_threshold: float = 0.5):
+        self.slow_threshold = slow_threshold
+
+    def record(self, metrics: StageMetrics):
+        level = logging.WARNING if metrics.duration >= self.slow_threshold else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(
+                level, 'loyalty stage %s %s: %.2fms, %s queries, %s rows',
+                metrics.stage, metrics.labels, metrics.duration * 1000, metrics.queries, metrics.rows,
+            )
+
+
+class CounterSink:
+    """Prometheus-style cumulative counters per stage: calls, seconds, queries and rows."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, float]] = dict()
+
+    def record(self, metrics: StageMetrics):
+        with self._lock:
+            counters = self._counters.setdefault(
+                metrics.stage, dict(calls=0, seconds=0.0, queries=0, rows=0)
+            )
+            counters['calls'] += 1
+            counters['seconds'] += metrics.duration
+            counters['queries'] += metrics.queries
+            counters['rows'] += metrics.rows
+
+    def collect(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: dict(counters) for stage, counters in self._counters.items()}
+
+    def exposition(self) -> str:
+        """Counters in the Prometheus text exposition format."""
+        lines = []
+        for name in ('calls', 'seconds', 'queries', 'rows'):
+            lines.append('# TYPE loyalty_stage_%s_total counter' % name)
+            for stage, counters in sorted(self.collect().items()):
+                lines.append('loyalty_stage_%s_total{stage="%s"} %s' % (name, stage, counters[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class MemorySink:
+    """Keep every recorded stage in memory, for tests and benchmarks."""
+
+    def __init__(self):
+        self.records: List[StageMetrics] = list()
+
+    def record(self, metrics: StageMetrics):
+        self.records.append(metrics)
+
+    def clear(self):
+        self.records = list()
+
+    def by_stage(self, stage: str) -> List[StageMetrics]:
+        return [metrics for metrics in self.records if metrics.stage == stage]
+
+
+class LoyaltyInstrumentation:
+    """Record the wall time, SQL query count and rows of the evaluation stages into pluggable sinks.
+
+    Nothing is measured while no sink is registered, and measuring a stage only adds a timer
+    and a query counter on the current connection, so it can stay enabled in production.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        if not self.sinks:
+            yield
+            return
+        counter = _QueryCounter()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield
+        finally:
+            metrics = StageMetrics(name, labels, time.perf_counter() - start, counter.queries, counter.rows)
+            for sink in self.sinks:
+                try:
+                    sink.record(metrics)
+                except Exception:
+                    logger.exception('loyalty instrumentation sink %r failed', sink)
+
+
+loyalty_instrumentation = LoyaltyInstrumentation(
+    sinks=[LoggingSink()] if getattr(settings, 'LOYALTY_INSTRUMENTATION_LOGGING', False) else []
+)
+
+
+def instrumented(stage: str):
+    """Measure an OrderLoyaltyProgram method as ``stage`` of :data:`loyalty_instrumentation`."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with loyalty_instrumentation.stage(stage, order_id=self.order.pk):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def order_locked(method):
+    """Run an OrderLoyaltyProgram write path holding the row lock of the order.
+
+    Concurrent applies on the same order are serialized. Under the lock the data already loaded
+    is checked against the database with :meth:`OrderLoyaltyProgram._revalidate` and only dropped
+    when another request changed it. Nested calls reuse the lock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._order_locked:
+            return method(self, *args, **kwargs)
+        with transaction.atomic():
+            order_updated_at = list(
+                Order.objects.select_for_update().filter(pk=self.order.pk).values_list('updated_at', flat=True)
+            )
+            self._order_locked = True
+            try:
+                self._revalidate(order_updated_at[0] if order_updated_at else None)
+                return method(self, *args, **kwargs)
+            finally:
+                self._order_locked = False
+    return wrapper
+
+
+# Traits của cấu hình instance, dùng chung giữa các request; giá trị cache không được sửa
+instance_traits_cache = LRUCache(maxsize=LOYALTY_TRAITS_CACHE_SIZE, max_age=LOYALTY_TRAITS_CACHE_MAX_AGE)
+
+
+def _freeze(value):
+    """Hashable, normalized form of a plugin_data value."""
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, Decimal) and value.is_finite() and value == value.to_integral_value():
+        return int(value)
+    return value
+
+
+class CatalogProgram:
+    """Read-only view of one active program inside a :class:`LoyaltyCatalogSnapshot`."""
+    __slots__ = ('program', 'conditions', 'rewards', 'condition_cycle_ids', 'has_cards', 'has_code_cards')
+
+    def __init__(self, program: LoyaltyProgram):
+        self.program = program
+        self.conditions: Tuple[ProgramCondition, ...] = tuple(program.active_conditions)
+        self.rewards: Tuple[RewardProgram, ...] = tuple(program.program_rewards.all())
+        self.condition_cycle_ids: Dict[int, FrozenSet[int]] = MappingProxyType({
+            condition.id: frozenset(cycle.id for cycle in condition.product_cycles.all())
+            for condition in self.conditions
+        })
+        self.has_cards = program._card_count > 0
+        self.has_code_cards = program._code_card_count > 0
+
+    def is_running(self, now) -> bool:
+        program = self.program
+        return program.start_time <= now and (program.end_time is None or program.end_time > now)
+
+
+class ConditionMatcher:
+    """Precompiled predicate table of the trait conditions of a catalog.
+
+    Conditions are grouped by ``attribute``: numeric operators keep sorted thresholds searched with
+    ``bisect``, equality operators keep hash sets of values (region, flavor, ...).
+    :meth:`match` evaluates all programs in one pass over the traits of an item. Conditions without
+    ``attribute`` always match; programs having a condition the compiler does not understand, or
+    one with an ``attribute_unit``, are listed in ``fallback_program_ids`` and must go through
+    ``get_all_matching_reward_conditions``.
+    """
+    NUMERIC_OPERATORS = {
+        '>': 'gt', 'gt': 'gt',
+        '>=': 'ge', 'ge': 'ge',
+        '<': 'lt', 'lt': 'lt',
+        '<=': 'le', 'le': 'le',
+    }
+    EQUALITY_OPERATORS = {
+        '=': 'eq', '==': 'eq', 'eq': 'eq',
+        '!=': 'ne', '<>': 'ne', 'ne': 'ne',
+    }
+
+    def __init__(self, programs: Tuple['CatalogProgram', ...]):
+        self.programs = programs
+        self.fallback_program_ids = set()
+        self._always = set()
+        # {attribute: {operator: ([threshold, ...], [condition_id, ...])}} sắp xếp theo threshold
+        self._numeric: Dict[str, Dict[str, Tuple[List[float], List[int]]]] = dict()
+        # {attribute: {value: {condition_id, ...}}}
+        self._equal: Dict[str, Dict[str, set]] = dict()
+        self._not_equal: Dict[str, Dict[str, set]] = dict()
+        numeric = dict()
+        for entry in programs:
+            for condition in entry.conditions:
+                if not self._compile(condition, numeric):
+                    self.fallback_program_ids.add(entry.program.id)
+        for attribute, operators in numeric.items():
+            self._numeric[attribute] = {
+                operator: (
+                    [threshold for threshold, _condition_id in pairs],
+                    [condition_id for _threshold, condition_id in pairs],
+                )
+                for operator, pairs in ((operator, sorted(pairs)) for operator, pairs in operators.items())
+            }
+
+    @staticmethod
+    def _as_number(value) -> Optional[float]:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _equality_key(cls, value) -> str:
+        number = cls._as_number(value)
+        if number is not None:
+            return repr(number)
+        # so sánh phân biệt hoa thường như matcher của model
+        return str(value)
+
+    def _compile(self, condition: ProgramCondition, numeric: dict) -> bool:
+        if not condition.attribute:
+            self._always.add(condition.id)
+            return True
+        if condition.attribute_unit:
+            # ngưỡng theo đơn vị (GB, TB, ...) cần quy đổi của model, để fallback xử lý
+            return False
+        operator = (condition.operator or '').strip().lower()
+        if operator in self.NUMERIC_OPERATORS:
+            threshold = self._as_number(condition.value)
+            if threshold is None:
+                return False
+            numeric.setdefault(condition.attribute, dict()).setdefault(
+                self.NUMERIC_OPERATORS[operator], []
+            ).append((threshold, condition.id))
+            return True
+        if operator in self.EQUALITY_OPERATORS:
+            table = self._equal if self.EQUALITY_OPERATORS[operator] == 'eq' else self._not_equal
+            table.setdefault(condition.attribute, dict()).setdefault(
+                self._equality_key(condition.value), set()
+            ).add(condition.id)
+            return True
+        return False
+
+    def _matching_condition_ids(self, traits: dict) -> set:
+        matched = set(self._always)
+        for attribute, operators in self._numeric.items():
+            value = self._as_number(traits.get(attribute))
+            if value is None:
+                continue
+            for operator, (thresholds, condition_ids) in operators.items():
+                if operator == 'gt':
+                    matched.update(condition_ids[:bisect.bisect_left(thresholds, value)])
+                elif operator == 'ge':
+                    matched.update(condition_ids[:bisect.bisect_right(thresholds, value)])
+                elif operator == 'lt':
+                    matched.update(condition_ids[bisect.bisect_right(thresholds, value):])
+                else:
+                    matched.update(condition_ids[bisect.bisect_left(thresholds, value):])
+        for attribute, values in self._equal.items():
+            if traits.get(attribute) is not None:
+                matched.update(values.get(self._equality_key(traits[attribute]), ()))
+        for attribute, values in self._not_equal.items():
+            if traits.get(attribute) is None:
+                continue
+            key = self._equality_key(traits[attribute])
+            for value, condition_ids in values.items():
+                if value != key:
+                    matched.update(condition_ids)
+        return matched
+
+    def match(self, traits: dict) -> Dict[int, List[ProgramCondition]]:
+        """Return ``{program_id: [condition, ...]}`` of the conditions matched by ``traits``."""
+        matched = self._matching_condition_ids(traits)
+        result = dict()
+        for entry in self.programs:
+            conditions = [condition for condition in entry.conditions if condition.id in matched]
+            if conditions:
+                result[entry.program.id] = conditions
+        return result
+
+
+class LoyaltyCatalogSnapshot:
+    """Immutable in-memory index of the active loyalty catalog.
+
+    Holds every non-wallet active program with its active conditions, rewards, condition cycles
+    and card rules, so evaluators read from memory instead of querying per item and per program.
+    The program list of a (product, cycle) pair is resolved once through ``available_product``
+    and memoized for the lifetime of the snapshot.
+    """
+
+    def __init__(self, version: int, programs: List[LoyaltyProgram], generation: int = 0, valid_until=None):
+        self.version = version
+        self.generation = generation
+        self.valid_until = valid_until
+        self.built_at = time.monotonic()
+        self.programs: Tuple[CatalogProgram, ...] = tuple(CatalogProgram(program) for program in programs)
+        self._by_id: Dict[int, CatalogProgram] = MappingProxyType({entry.program.id: entry for entry in self.programs})
+        self._rewards_by_id: Dict[int, RewardProgram] = MappingProxyType({
+            reward.id: reward for entry in self.programs for reward in entry.rewards
+        })
+        self._product_cycle_index: Dict[Tuple[int, Optional[int]], FrozenSet[int]] = dict()
+        self._index_lock = threading.Lock()
+        self._condition_matcher: Optional[ConditionMatcher] = None
+        self._serialized_rewards: Dict[Tuple[int, Optional[str]], MappingProxyType] = dict()
+
+    @classmethod
+    def build(cls, version: int, generation: int = 0) -> 'LoyaltyCatalogSnapshot':
+        now = timezone.now()
+        programs = LoyaltyProgram.objects.exclude(
+            program_type=ProgramTypes.wallet
+        ).active(
+            code=None, program_type=None
+        ).annotate(
+            _card_count=Count('loyalty_cards', distinct=True),
+            _code_card_count=Count('loyalty_cards', filter=Q(loyalty_cards__code__isnull=False), distinct=True),
+        ).prefetch_related(
+            Prefetch(
+                'program_conditions',
+                queryset=ProgramCondition.objects.active().prefetch_related('product_cycles'),
+                # không ghi đè program_conditions.all() mà các method của model đọc
+                to_attr='active_conditions',
+            ),
+            'program_rewards',
+        ).order_by('priority', 'id')
+        # program chưa bắt đầu không có trong active(), snapshot được build lại khi program đầu tiên bắt đầu
+        valid_until = LoyaltyProgram.objects.exclude(
+            program_type=ProgramTypes.wallet
+        ).filter(start_time__gt=now).aggregate(next_start=Min('start_time'))['next_start']
+        return cls(version=version, programs=list(programs), generation=generation, valid_until=valid_until)
+
+    def is_expired(self, generation: int = None) -> bool:
+        if generation is not None and generation != self.generation:
+            return True
+        if self.valid_until is not None and timezone.now() >= self.valid_until:
+            return True
+        return time.monotonic() - self.built_at > LOYALTY_CATALOG_MAX_AGE
+
+    def get(self, program) -> Optional[CatalogProgram]:
+        return self._by_id.get(getattr(program, 'id', program))
+
+    def conditions(self, program) -> Tuple[ProgramCondition, ...]:
+        entry = self.get(program)
+        return entry.conditions if entry else tuple()
+
+    def rewards(self, program) -> Tuple[RewardProgram, ...]:
+        entry = self.get(program)
+        return entry.rewards if entry else tuple()
+
+    def reward(self, reward_id) -> Optional[RewardProgram]:
+        return self._rewards_by_id.get(reward_id)
+
+    def serialized_reward(self, reward: RewardProgram) -> MappingProxyType:
+        """``RewardProgramClientSerializer`` data of ``reward``, serialized once per snapshot and language.
+
+        Rewards do not change within a snapshot, so listings only pay for the rewards they show
+        the first time and copy the cached mapping afterwards.
+        """
+        key = (reward.id, get_language())
+        data = self._serialized_rewards.get(key)
+        if data is None:
+            # dict thường, không giữ tham chiếu tới serializer như ReturnDict
+            data = MappingProxyType(dict(RewardProgramClientSerializer(reward).data))
+            self._serialized_rewards[key] = data
+        return data
+
+    def condition_cycle_ids(self, program, condition) -> FrozenSet[int]:
+        entry = self.get(program)
+        return entry.condition_cycle_ids.get(condition.id, frozenset()) if entry else frozenset()
+
+    @property
+    def condition_matcher(self) -> ConditionMatcher:
+        if self._condition_matcher is None:
+            with self._index_lock:
+                if self._condition_matcher is None:
+                    self._condition_matcher = ConditionMatcher(self.programs)
+        return self._condition_matcher
+
+    def _available_program_ids(self, product, cycle) -> FrozenSet[int]:
+        key = (product.id, getattr(cycle, 'id', None))
+        program_ids = self._product_cycle_index.get(key)
+        if program_ids is None:
+            # query ngoài lock để cache miss không chặn các thread khác, chỉ lock khi ghi kết quả
+            product_and_programs = LoyaltyProgram.objects.filter(
+                id__in=self._by_id.keys()
+            ).available_product(product, cycle)
+            program_ids = frozenset(
+                program.id for program in product_and_programs.get(product, [])
+            ) if product_and_programs else frozenset()
+            with self._index_lock:
+                program_ids = self._product_cycle_index.setdefault(key, program_ids)
+        return program_ids
+
+    def code_program_ids(self, code) -> FrozenSet[int]:
+        """Catalog programs having a loyalty card with ``code``, resolved with one query."""
+        return frozenset(
+            LoyaltyCard.objects.filter(
+                program_id__in=[entry.program.id for entry in self.programs if entry.has_code_cards],
+                code=code,
+            ).values_list('program_id', flat=True)
+        ) if code else frozenset()
+
+    def programs_for(self, product, cycle, code=None, program_type: str = None,
+                     code_program_ids: FrozenSet[int] = None) -> List[LoyaltyProgram]:
+        """Active programs applicable to ``product`` on ``cycle``, in catalog order (priority, then id).
+
+        Pass ``code_program_ids`` (from :meth:`code_program_ids`) when resolving many products
+        for the same ``code``.
+        """
+        program_ids = self._available_program_ids(product, cycle)
+        if not program_ids:
+            return []
+        if code:
+            if code_program_ids is None:
+                code_program_ids = self.code_program_ids(code)
+            program_ids = program_ids & code_program_ids
+        now = timezone.now()
+        return [
+            entry.program for entry in self.programs
+            if entry.program.id in program_ids
+            and (program_type is None or entry.program.program_type == program_type)
+            and entry.is_running(now)
+        ]
+
+
+_catalog_versions = itertools.count(1)
+_catalog_lock = threading.Lock()
+_catalog: Optional[LoyaltyCatalogSnapshot] = None
+
+
+def get_loyalty_catalog() -> LoyaltyCatalogSnapshot:
+    """Return the process-wide catalog snapshot.
+
+    The snapshot is rebuilt lazily on the first read after another worker (or this one) bumped
+    the catalog generation, or when it is older than ``LOYALTY_CATALOG_MAX_AGE``.
+    """
+    global _catalog
+    generation = catalog_generation.current()
+    catalog = _catalog
+    if catalog is None or catalog.is_expired(generation):
+        with _catalog_lock:
+            if _catalog is None or _catalog.is_expired(generation):
+                _catalog = LoyaltyCatalogSnapshot.build(
+                    version=next(_catalog_versions), generation=generation
+                )
+            catalog = _catalog
+    return catalog
+
+
+def reset_loyalty_catalog():
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+def invalidate_loyalty_catalog():
+    """Bump the shared catalog generation once the current transaction commits."""
+    transaction.on_commit(catalog_generation.bump)
+
+
+# Snapshot chỉ dùng số thẻ (có code) của mỗi program, các field khác của thẻ không ảnh hưởng catalog
+LOYALTY_CARD_CATALOG_FIELDS = ('code', 'program_id')
+
+
+def _remember_card_catalog_fields(sender, instance, **kwargs):
+    instance._catalog_fields = tuple(
+        instance.__dict__.get(field) for field in LOYALTY_CARD_CATALOG_FIELDS
+    )
+
+
+def _card_changes_catalog(card) -> bool:
+    """Whether ``card`` gives its program its first card (or first code card).
+
+    The snapshot only keeps ``has_cards`` / ``has_code_cards`` of each program, other card changes
+    are read live by LoyaltyCardResolver and ``code_program_ids``.
+    """
+    catalog = _catalog
+    if catalog is not None and not catalog.is_expired():
+        entry = catalog.get(card.program_id)
+        # program không có trong snapshot sẽ được đếm lại khi nó vào catalog
+        return entry is not None and (
+            not entry.has_cards or (card.code is not None and not entry.has_code_cards)
+        )
+    other_cards = LoyaltyCard.objects.filter(program_id=card.program_id).exclude(pk=card.pk)
+    if card.code is not None:
+        other_cards = other_cards.filter(code__isnull=False)
+    return not other_cards.exists()
+
+
+def _on_catalog_model_changed(sender, instance, **kwargs):
+    if sender is LoyaltyCard and kwargs.get('signal') is post_save:
+        # field bị defer và chưa được nạp thì không thể đã thay đổi
+        catalog_fields = tuple(instance.__dict__.get(field) for field in LOYALTY_CARD_CATALOG_FIELDS)
+        previous_fields = getattr(instance, '_catalog_fields', None)
+        instance._catalog_fields = catalog_fields
+        if not kwargs.get('created'):
+            if previous_fields == catalog_fields:
+                return
+            if previous_fields is not None and previous_fields[1] != catalog_fields[1]:
+                # đổi program: program cũ có thể mất thẻ cuối cùng
+                invalidate_loyalty_catalog()
+                return
+        if not _card_changes_catalog(instance):
+            return
+    invalidate_loyalty_catalog()
+
+
+def _on_catalog_m2m_changed(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_loyalty_catalog()
+
+
+def connect_loyalty_catalog_signals():
+    """Invalidate the catalog snapshot when programs, conditions, rewards or cards change.
+
+    Every process writing these models (web, admin, celery, management commands) must connect
+    the handlers, so call this from the ``ready()`` of the billing ``AppConfig``; importing this
+    module also connects them. Connecting more than once is a no-op.
+    """
+    post_init.connect(
+        _remember_card_catalog_fields, sender=LoyaltyCard,
+        dispatch_uid='loyalty_catalog_init_%s' % LoyaltyCard._meta.label_lower,
+    )
+    for model in (LoyaltyProgram, ProgramCondition, RewardProgram, LoyaltyCard):
+        post_save.connect(
+            _on_catalog_model_changed, sender=model,
+            dispatch_uid='loyalty_catalog_save_%s' % model._meta.label_lower,
+        )
+        post_delete.connect(
+            _on_catalog_model_changed, sender=model,
+            dispatch_uid='loyalty_catalog_delete_%s' % model._meta.label_lower,
+        )
+    for through in (
+        ProgramCondition.product_cycles.through,
+        ProgramCondition.products.through,
+        ProgramCondition.product_groups.through,
+        RewardProgram.products.through,
+        RewardProgram.product_groups.through,
+    ):
+        m2m_changed.connect(
+            _on_catalog_m2m_changed, sender=through,
+            dispatch_uid='loyalty_catalog_m2m_%s' % through._meta.label_lower,
+        )
+
+
+connect_loyalty_catalog_signals()
+
+
+def upsert_order_point_rewards(entries) -> List[OrderPointReward]:
+    """Create or update the OrderPointReward of every ``(order, client, program, points)`` entry.
+
+    Existing rows are loaded with one query, missing rows are bulk created and changed points
+    bulk updated in a single transaction. Rows duplicated on ``(order, program, client)`` are
+    merged into the oldest one. Callers must hold the order lock (:func:`order_locked`) so
+    concurrent applies cannot insert the same row twice. Returns the rows in the order of ``entries``.
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+    existing_order_points = dict()
+    duplicates = dict()
+    # sắp xếp tăng dần để bản ghi có id nhỏ nhất được giữ lại, giống .first()
+    for order_points in OrderPointReward.objects.filter(
+        order_id__in={order.pk for order, _client, _program, _points in entries},
+        program_id__in={program.pk for _order, _client, program, _points in entries},
+    ).order_by('pk'):
+        key = (order_points.order_id, order_points.program_id, order_points.client_id)
+        if key in existing_order_points:
+            duplicates.setdefault(existing_order_points[key], []).append(order_points.pk)
+        else:
+            existing_order_points[key] = order_points
+    if duplicates:
+        # dọn các bản ghi trùng do apply song song trước đây
+        with transaction.atomic():
+            for order_points, duplicate_ids in duplicates.items():
+                OrderItem.objects.filter(order_point_reward_id__in=duplicate_ids).update(
+                    order_point_reward=order_points
+                )
+            OrderPointReward.objects.filter(
+                pk__in=[pk for duplicate_ids in duplicates.values() for pk in duplicate_ids]
+            ).delete()
+    coupons = []
+    to_create = []
+    to_update = []
+    for order, client, program, points in entries:
+        order_points = existing_order_points.get((order.pk, program.pk, getattr(client, 'pk', None)))
+        if not order_points:
+            order_points = OrderPointReward(
+                order=order,
+                points=points,
+                program=program,
+                client=client,
+            )
+            to_create.append(order_points)
+        elif order_points.points != points:
+            order_points.points = points
+            to_update.append(order_points)
+        coupons.append(order_points)
+    with transaction.atomic():
+        if to_create:
+            OrderPointReward.objects.bulk_create(to_create)
+        if to_update:
+            OrderPointReward.objects.bulk_update(to_update, ['points'])
+    return coupons
+
+
+def allocate_amount(amount: Decimal, weights: List[Decimal], quantum: Decimal = Decimal(1)) -> List[Decimal]:
+    """Split ``amount`` proportionally to ``weights`` in multiples of ``quantum``.
+
+    Uses the largest remainder method so the parts always sum exactly to ``amount`` (rounded down
+    to the quantum and capped at the sum of the weights); no part exceeds its weight.
+    """
+    weights = [max(Decimal(weight), Decimal(0)) for weight in weights]
+    total_weight = sum(weights, Decimal(0))
+    amount = min(Decimal(amount), total_weight).quantize(quantum, rounding=decimal.ROUND_DOWN)
+    if amount <= 0:
+        return [Decimal(0) * quantum for _weight in weights]
+    units = int(amount / quantum)
+    exact = [amount * weight / total_weight / quantum for weight in weights]
+    parts = [int(value) for value in exact]
+    remainder = units - sum(parts)
+    # phần lẻ lớn nhất nhận thêm một quantum, sort ổn định nên kết quả luôn xác định
+    for index in sorted(range(len(weights)), key=lambda index: exact[index] - parts[index], reverse=True)[:remainder]:
+        parts[index] += 1
+    return [quantum * part for part in parts]
+
+
+def save_reward_prices(assignments) -> int:
+    """Write the ``(reward, coupon, [ItemRewardPrice])`` assignments with one bulk update per table.
+
+    Returns the number of order items updated.
+    """
+    items_to_update = []
+    options_to_update = []
+    for reward, coupon, item_prices in assignments:
+        for item_price in item_prices:
+            for configurable_options, base_price in item_price.option_prices:
+                configurable_options.price = base_price
+                # configurable_options.unit_price = base_price
+                options_to_update.append(configurable_options)
+            item = item_price.item
+            item.fixed_price = item_price.fixed_price
+            item.total = item_price.total
+            item.discount = item_price.discount
+            item.program_reward = reward
+            item.order_point_reward = coupon
+            items_to_update.append(item)
+    with transaction.atomic():
+        if options_to_update:
+            type(options_to_update[0]).objects.bulk_update(options_to_update, ['price', 'unit_price'])
+        if items_to_update:
+            OrderItem.objects.bulk_update(
+                items_to_update, ['total', 'fixed_price', 'discount', 'program_reward', 'order_point_reward']
+            )
+    return len(items_to_update)
+
 
 class OrderItemProductProgram:
+    __slots__ = ('item', 'product', 'programs')
+
     def __init__(self, item, product, programs):
         self.item = item
         self.product = product
         self.programs = programs
 
-class ItemProgram:
-    def __init__(self, item: OrderItem, program: LoyaltyProgram):
+class ItemProgramIndex:
+    """Association store of order items matched by programs.
+
+    Indexed by ``(item_id, program_id)`` for O(1) membership tests and by ``program_id``
+    for the items of a program, in insertion order.
+    """
+    __slots__ = ('_pairs', '_items_by_program')
+
+    def __init__(self):
+        self._pairs = set()
+        self._items_by_program: Dict[int, List[OrderItem]] = dict()
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __bool__(self):
+        return bool(self._pairs)
+
+    def contains(self, item: OrderItem, program) -> bool:
+        return (item.id, getattr(program, 'id', program)) in self._pairs
+
+    def add(self, item: OrderItem, program):
+        key = (item.id, getattr(program, 'id', program))
+        if key in self._pairs:
+            return
+        self._pairs.add(key)
+        self._items_by_program.setdefault(key[1], []).append(item)
+
+    def items_for(self, program) -> List[OrderItem]:
+        return list(self._items_by_program.get(getattr(program, 'id', program), ()))
+
+# Quan hệ của order item được nạp sẵn cho toàn bộ quá trình đánh giá
+ORDER_ITEM_GRAPH_RELATED = ('product', 'cycle', 'service__cycle')
+ORDER_ITEM_GRAPH_PREFETCH = ('configurable_options__option__cycles',)
+
+
+def order_items_graph_queryset() -> "QuerySet[OrderItem]":
+    return OrderItem.objects.select_related(
+        *ORDER_ITEM_GRAPH_RELATED
+    ).prefetch_related(*ORDER_ITEM_GRAPH_PREFETCH)
+
+
+class OrderGraph:
+    """Order items with their product, service, cycles and configurable options.
+
+    Loaded in a fixed number of queries whatever the cart size, then read without touching
+    the database: ``items`` in order and the first cycle of every configurable option.
+    """
+    __slots__ = ('items', '_option_cycles')
+
+    def __init__(self, items: List[OrderItem]):
+        self.items: Tuple[OrderItem, ...] = tuple(items)
+        self._option_cycles = dict()
+        for item in self.items:
+            for configurable_options in item.configurable_options.all():
+                option = configurable_options.option
+                if option is not None and option.id not in self._option_cycles:
+                    self._option_cycles[option.id] = self._first_cycle(option)
+
+    @classmethod
+    def load(cls, order: Order) -> 'OrderGraph':
+        if 'items' in getattr(order, '_prefetched_objects_cache', {}):
+            items = list(order.items.all())
+            # bổ sung các quan hệ còn thiếu, các quan hệ đã nạp được bỏ qua
+            prefetch_related_objects(items, *ORDER_ITEM_GRAPH_RELATED, *ORDER_ITEM_GRAPH_PREFETCH)
+        else:
+            items = list(order_items_graph_queryset().filter(order=order))
+        return cls(items)
+
+    @staticmethod
+    def _first_cycle(option):
+        """``option.cycles.first()`` served from the prefetched cycles."""
+        cycles = list(option.cycles.all())
+        if not cycles:
+            return None
+        if option.cycles.model._meta.ordering:
+            return cycles[0]
+        return min(cycles, key=lambda cycle: cycle.pk)
+
+    def state(self) -> tuple:
+        """Fingerprint of the loaded items, comparable with :meth:`current_state`."""
+        if not self.items:
+            return 0, None, None, None, None
+        return (
+            len(self.items),
+            max(item.updated_at for item in self.items),
+            sum(item.total for item in self.items),
+            sum(item.fixed_price for item in self.items),
+            sum(item.quantity for item in self.items),
+        )
+
+    @staticmethod
+    def current_state(order) -> tuple:
+        """Fingerprint of the items of ``order`` in the database, one aggregate query.
+
+        Prices are part of it since ``bulk_update`` does not touch ``updated_at``.
+        """
+        state = OrderItem.objects.filter(order=order).aggregate(
+            count=Count('id'), updated_at=Max('updated_at'), total=Sum('total'),
+            fixed_price=Sum('fixed_price'), quantity=Sum('quantity'),
+        )
+        return state['count'], state['updated_at'], state['total'], state['fixed_price'], state['quantity']
+
+    def option_cycle(self, option):
+        if option.id not in self._option_cycles:
+            self._option_cycles[option.id] = self._first_cycle(option)
+        return self._option_cycles[option.id]
+
+
+class OrderTotals:
+    """Snapshot of the order amounts read by the evaluator, loaded with a single query.
+
+    Holds the grand total, the subtotals by ``item_type`` and the ``amount_origin`` of every item,
+    the same values ``total_origin()`` aggregates.
+    """
+    __slots__ = ('grand_total', 'by_type', 'by_item')
+
+    def __init__(self, order_items):
+        self.grand_total = Decimal('0')
+        self.by_type: Dict[str, Decimal] = dict()
+        self.by_item: Dict[str, Decimal] = dict()
+        for item in order_items:
+            amount = Decimal(item.amount_origin or 0)
+            self.by_item[item.id] = amount
+            self.by_type[item.item_type] = self.by_type.get(item.item_type, Decimal('0')) + amount
+            self.grand_total += amount
+
+    def subtotal(self, item_type) -> Decimal:
+        return self.by_type.get(item_type, Decimal('0'))
+
+
+class LoyaltyCardResolver:
+    """Loyalty card eligibility of one user, resolved with a single query.
+
+    Loads every non-expired card visible to ``user`` (its own cards and public ones) across
+    ``program_ids`` and indexes them by program and by ``(program_id, code)``. Only the codes
+    asked for and the user's own codes are indexed, public cards of a program collapse to one row.
+    """
+
+    def __init__(self, user, program_ids, codes=()):
+        self.program_ids = set()
+        self.codes = set()
+        codes = [code for code in codes if code]
+        if not program_ids:
+            return
+        rows = LoyaltyCard.objects.filter(
+            program_id__in=program_ids
+        ).filter(
+            Q(expiration_time__isnull=True) | Q(expiration_time__gt=timezone.now())
+        ).filter(
+            Q(partner=user) | Q(partner__isnull=True)
+        ).annotate(
+            indexed_code=Case(
+                When(Q(code__in=codes) | Q(partner=user), then=F('code')),
+                default=Value(None),
+            )
+        ).values_list('program_id', 'indexed_code').distinct()
+        for program_id, code in rows:
+            self.program_ids.add(program_id)
+            if code is not None:
+                self.codes.add((program_id, code))
+
+    @classmethod
+    def for_users(cls, users, program_ids) -> Dict[Optional[int], 'LoyaltyCardResolver']:
+        """One resolver per user of ``users`` (keyed by user id), loaded with a single query."""
+        resolvers = {getattr(user, 'pk', None): cls(user, ()) for user in users}
+        if not program_ids or not resolvers:
+            return resolvers
+        user_ids = [user_id for user_id in resolvers if user_id is not None]
+        rows = LoyaltyCard.objects.filter(
+            program_id__in=program_ids
+        ).filter(
+            Q(expiration_time__isnull=True) | Q(expiration_time__gt=timezone.now())
+        ).filter(
+            Q(partner_id__in=user_ids) | Q(partner__isnull=True)
+        ).values_list('program_id', 'partner_id', 'code').distinct()
+        for program_id, partner_id, code in rows:
+            if partner_id is None:
+                # thẻ public: mọi user đều dùng được
+                for resolver in resolvers.values():
+                    resolver.program_ids.add(program_id)
+                continue
+            resolver = resolvers[partner_id]
+            resolver.program_ids.add(program_id)
+            if code is not None:
+                resolver.codes.add((program_id, code))
+        return resolvers
+
+    def is_available(self, program, code=None) -> bool:
+        """Whether the user holds a valid card of ``program`` (with ``code`` when given)."""
+        program_id = getattr(program, 'id', program)
+        if code:
+            return (program_id, code) in self.codes
+        return program_id in self.program_ids
+
+
+class ItemRewardPrice:
+    """Discounted prices of one order item for a reward, as computed before saving."""
+
+    def __init__(self, item: OrderItem, fixed_price, total, discount, option_prices):
         self.item = item
-        self.program = program
+        self.fixed_price = fixed_price
+        self.total = total
+        self.discount = discount
+        # [(OrderItemConfigurableOption, price)]
+        self.option_prices = option_prices
+
+    def as_dict(self) -> dict:
+        return {
+            'item_id': self.item.id,
+            'fixed_price': self.fixed_price,
+            'total': self.total,
+            'discount': self.discount,
+            'configurable_options': [
+                {'id': configurable_options.id, 'price': price}
+                for configurable_options, price in self.option_prices
+            ],
+        }
 
 class OrderLoyaltyProgram:
 
-    def __init__(self, order: Order):
+    def __init__(self, order: Order, catalog: LoyaltyCatalogSnapshot = None):
         self.order = order
-        self.billing_settings: BillingSettings = self.order.client.billing_settings
+        self.catalog = catalog or get_loyalty_catalog()
         self.currency = self.order.currency
         self._traits = self.__compute_traits()
         self._coupon: List[OrderPointReward] = list()
         self.item_product_programs: List[OrderItemProductProgram] = list()
-        self.item_programs: List[ItemProgram] = list()
+        self.item_programs = ItemProgramIndex()
+        # Kết quả get_active_programs / _order_program_check_compute_points được dùng lại
+        # cho tới khi order items thay đổi
+        self._active_programs_key = None
+        self._evaluation: Optional[dict] = None
+        self._evaluation_code = None
+        # {item_id: (traits, {program_id: [condition, ...]})}
+        self._item_traits: dict = dict()
+        self._pricing_version: Optional[int] = None
+        self._card_resolvers: Dict[Optional[str], LoyaltyCardResolver] = dict()
+        self._totals: Optional[OrderTotals] = None
+        self._graph: Optional[OrderGraph] = None
+        self._remaining_usage: Dict[int, int] = dict()
+        self._order_locked = False
 
     @property
     def client(self):
         return self.order.client
 
-    @property
+    @cached_property
+    def billing_settings(self) -> BillingSettings:
+        return self.order.client.billing_settings
+
+    @cached_property
     def user(self):
         return self.client.users.first()
 
+    def preload(self, user, card_resolver: 'LoyaltyCardResolver' = None, remaining_usage: Dict[int, int] = None):
+        """Seed the per-order lookups with data loaded once for many orders (see BatchOrderEvaluator).
+
+        ``remaining_usage`` is used as the memo of :meth:`remaining_usage` and filled by it, so it
+        can be shared between the orders of the same user.
+        """
+        self.__dict__['user'] = user
+        if card_resolver is not None:
+            self._card_resolvers[None] = card_resolver
+        if remaining_usage is not None:
+            self._remaining_usage = remaining_usage
+
+    def card_resolver(self, code=None) -> LoyaltyCardResolver:
+        """Card eligibility of the order user for every catalog program having cards."""
+        if code is None and self._card_resolvers:
+            # resolver nào cũng có đủ program_ids, chỉ khác các code được index
+            return next(iter(self._card_resolvers.values()))
+        if code not in self._card_resolvers:
+            self._card_resolvers[code] = LoyaltyCardResolver(
+                self.user,
+                [entry.program.id for entry in self.catalog.programs if entry.has_cards],
+                codes=[code],
+            )
+        return self._card_resolvers[code]
+
     @property
     def order_items(self):
         return self.order.items.all()
 
+    @property
+    def graph(self) -> OrderGraph:
+        if self._graph is None:
+            self._graph = OrderGraph.load(self.order)
+        return self._graph
+
+    @property
+    def item_list(self) -> Tuple[OrderItem, ...]:
+        return self.graph.items
+
+    @property
+    def totals(self) -> OrderTotals:
+        if self._totals is None:
+            self._totals = OrderTotals(self.item_list)
+        return self._totals
+
     @property
     def total_amount(self):
-        return self.order_items.total_origin()
+        return self.totals.grand_total
 
     @property
     def total_order_amount(self):
@@ -79,28 +1271,74 @@ class OrderLoyaltyProgram:
     def add_item_product_program(self, item, product, programs):
         self.item_product_programs.append(OrderItemProductProgram(item, product, programs))
 
+    def _reset_evaluation(self):
+        self._active_programs_key = None
+        self._evaluation = None
+        self._evaluation_code = None
+        self._item_traits = dict()
+        self.item_product_programs = list()
+        self.item_programs = ItemProgramIndex()
+
+    def _revalidate(self, order_updated_at):
+        """Drop the data another request changed since it was loaded, called under the order lock."""
+        if self._graph is not None and (
+            order_updated_at != self.order.updated_at
+            or OrderGraph.current_state(self.order) != self._graph.state()
+        ):
+            self.invalidate_evaluation()
+            return
+        for program_id, remaining in list(self._remaining_usage.items()):
+            entry = self.catalog.get(program_id)
+            current = entry.program.remaining_quantity(self.user) if entry else None
+            if current != remaining:
+                # kết quả đánh giá phụ thuộc số lượt còn lại
+                self._remaining_usage = dict()
+                self._reset_evaluation()
+                return
+
+    def invalidate_evaluation(self):
+        """Drop the memoized active programs, evaluation and order data, must be called when order items change."""
+        self._reset_evaluation()
+        self._totals = None
+        self._graph = None
+        self._remaining_usage = dict()
+        getattr(self.order, '_prefetched_objects_cache', {}).pop('items', None)
+
+    def evaluate_programs(self, code=None) -> dict:
+        """Memoized :meth:`_order_program_check_compute_points` for the current active programs."""
+        if self._evaluation is None or self._evaluation_code != code:
+            self._evaluation = self._order_program_check_compute_points(code=code)
+            self._evaluation_code = code
+        return self._evaluation
+
+    @instrumented('get_active_programs')
     def get_active_programs(self, code=None, program_type: str = None):
         """the method returm all Loyalty Program applicable to order
         :rtype: dict
         """
-        for item in self.order_items.filter(product__isnull=False).select_related('product'):
+        key = (code, program_type)
+        if self._active_programs_key == key:
+            return
+        self._reset_evaluation()
+        self._active_programs_key = key
+        code_program_ids = self.catalog.code_program_ids(code) if code else None
+        for item in self.item_list:
+            if item.product_id is None:
+                continue
             if item.service and item.service.is_price_overridden and item.service.cycle == item.cycle:
                 # Đang sử dụng trọn đời cùng chu kỳ không thể áp dụng chương trình
                 continue
-            product_and_programs = LoyaltyProgram.objects.exclude(
-                program_type=ProgramTypes.wallet
-            ).active(
-                code=code, program_type=program_type
-            ).available_product(item.product, item.cycle)
-
-            if product_and_programs:
-                self.add_item_product_program(
-                    item=item, product=item.product, programs=product_and_programs[item.product]
-                )
+            programs = self.catalog.programs_for(
+                item.product, item.cycle, code=code, program_type=program_type,
+                code_program_ids=code_program_ids,
+            )
+            if programs:
+                self.add_item_product_program(item=item, product=item.product, programs=programs)
 
     # def _order_apply_program(self, code=None):
     #     return self._apply_program(self._order_program_check_compute_points(code=code))
 
+    @instrumented('apply_program')
     def _apply_program(self, programs_and_point):
         """Create order point reward for order and return list order point created
 
@@ -111,25 +1349,14 @@ class OrderLoyaltyProgram:
         else:
             quantity_program_apply = self.billing_settings.maximum_quantity_program_order_possible_apply
         # programs ordered by priority
-        loop_count = 0
-        for program, data in programs_and_point.items():
-            loop_count += 1
-            order_points = self.order.orderpointreward_set.filter(program=program, client=self.client).first()
-            if not order_points:
-                order_points = OrderPointReward.objects.create(
-                    order=self.order,
-                    points=data['points'],
-                    program=program,
-                    client=self.client,
-                )
-            elif order_points.points != data['points']:
-                order_points.points = data['points']
-                order_points.save(update_fields=['points'])
-            self._coupon.append(order_points)
-            # if loop_count == quantity_program_apply:
-            #     break
+        coupons = upsert_order_point_rewards([
+            (self.order, self.client, program, data['points'])
+            for program, data in programs_and_point.items()
+        ])
+        self._coupon.extend(coupons)
         return self._coupon
 
+    @instrumented('get_claimable_rewards')
     def _get_claimable_rewards(self):
         """
         Fetch all rewards that are currently claimable from all concerned coupons,
@@ -139,30 +1366,67 @@ class OrderLoyaltyProgram:
         Coupons that can not claim any reward are not contained in the result.
         """
         total_is_zero = cdecimal(self.total_order_amount, q="0.0001") < 1
+        rewards_by_program = self._get_rewards_by_program(
+            {order_point_reward.program_id for order_point_reward in self._coupon}
+        )
         result: dict = dict()
         for order_point_reward in self._coupon:
-            rewards: "QuerySet[RewardProgram]" = order_point_reward.program.program_rewards.all()
-            result_rewards: List[RewardProgram] = []
-            for reward in rewards:
-                if reward.reward_type == RewardProgram.DISCOUNT and total_is_zero:
-                    continue
-                # if not reward.program.unlimited and reward._remain_quantity(self.user) < 1:
-                #     continue
-                if reward.required_point > order_point_reward.points:
-                    continue
-                result_rewards.append(reward)
+            result_rewards = self._filter_claimable_rewards(
+                rewards_by_program.get(order_point_reward.program_id, []),
+                order_point_reward.points,
+                total_is_zero,
+            )
             if result_rewards:
-                result[order_point_reward] = rewards.filter(
-                    id__in=[reward.id for reward in result_rewards]
-                ).order_by("-discount")
+                result[order_point_reward] = result_rewards
         return result
 
+    def _get_rewards_by_program(self, program_ids) -> Dict[int, List[RewardProgram]]:
+        """Rewards of ``program_ids`` ordered by discount descending.
+
+        Served from the catalog, programs missing from it are loaded with a single query.
+        """
+        result: Dict[int, List[RewardProgram]] = dict()
+        missing = []
+        for program_id in program_ids:
+            entry = self.catalog.get(program_id)
+            if entry is None:
+                missing.append(program_id)
+            else:
+                result[program_id] = sorted(entry.rewards, key=lambda reward: reward.discount, reverse=True)
+        if missing:
+            for reward in RewardProgram.objects.filter(program_id__in=missing).order_by('-discount'):
+                result.setdefault(reward.program_id, []).append(reward)
+        return result
+
+    @staticmethod
+    def _filter_claimable_rewards(rewards, points, total_is_zero: bool) -> List[RewardProgram]:
+        result_rewards: List[RewardProgram] = []
+        for reward in rewards:
+            if reward.reward_type == RewardProgram.DISCOUNT and total_is_zero:
+                continue
+            # if not reward.program.unlimited and reward._remain_quantity(self.user) < 1:
+            #     continue
+            if reward.required_point > points:
+                continue
+            result_rewards.append(reward)
+        return result_rewards
+
+    @staticmethod
+    def _find_reward_coupon(coupon_and_rewards: dict, reward: RewardProgram) -> Optional[OrderPointReward]:
+        """Coupon able to claim ``reward`` in a :meth:`_get_claimable_rewards` result."""
+        reward_coupons = dict()
+        for coupon, rewards in coupon_and_rewards.items():
+            for claimable_reward in rewards:
+                reward_coupons.setdefault(claimable_reward.id, coupon)
+        return reward_coupons.get(reward.id)
+
+    @order_locked
     def _order_try_apply_coupon(self, code):
         self.get_active_programs(code)
         if not self.item_product_programs:
             return False, "No program available"
-        programs_and_point = self._order_program_check_compute_points(code=code)
-       
+        programs_and_point = self.evaluate_programs(code=code)
+
         if not programs_and_point:
             return False, "No program available"
         if isinstance(programs_and_point, dict):
@@ -181,28 +1445,30 @@ class OrderLoyaltyProgram:
                 return self._order_apply_reward(reward_large, coupon), _("Applied coupon")
         return False, _("Can not apply coupon")
 
+    @order_locked
     def _get_rewards_type_promotion(self):
         self.get_active_programs(code=None, program_type=ProgramTypes.promotion)
         if not self.item_product_programs:
             return False
-        if not self._apply_program(self._order_program_check_compute_points()):
+        if not self._apply_program(self.evaluate_programs()):
             return False
         return self._get_claimable_rewards()
 
+    @order_locked
     def _order_try_apply_reward(self, reward: RewardProgram) -> Tuple[bool, str]:
         program = reward.program
+        catalog_program = self.catalog.get(program)
+        if catalog_program is None:
+            return False, _("Program not available")
         if (
-            program.loyalty_cards.exists() 
-            and not program.loyalty_cards.filter(
-                Q(expiration_time__isnull=True)
-                | Q(expiration_time__gt=timezone.now())
-            ).filter(Q(partner=self.user) | Q(partner__isnull=True)).exists()
+            catalog_program.has_cards
+            and not self.card_resolver().is_available(program)
         ):
             return False, _("Program not available")
         self.get_active_programs(code=None, program_type=ProgramTypes.promotion)
         if not self.item_product_programs:
             return False, _("Program not available")
-        programs_and_point = self._order_program_check_compute_points()
+        programs_and_point = self.evaluate_programs()
         if isinstance(programs_and_point, dict):
             point_and_error = programs_and_point.get(reward.program)  # {program: {'points': number, 'error': str}} => {'points': number, 'error': str}
             if not point_and_error:
@@ -215,95 +1481,274 @@ class OrderLoyaltyProgram:
         order_point_rewards = self._get_claimable_rewards()
         if not order_point_rewards:
             return False, _("Can not claim program")
-        if reward not in list(chain.from_iterable(order_point_rewards.values())):  # [[reward1], ..., [reward2, ...]] => [reward1, reward2]
+        order_point_reward = self._find_reward_coupon(order_point_rewards, reward)
+        if order_point_reward is None:
             return False, _("Program not available")
 
-        for order_point_reward, rewards in order_point_rewards.items():
-            if reward in rewards:
-                self._order_apply_reward(reward, order_point_reward)
-                break
+        self._order_apply_reward(reward, order_point_reward)
         return True, _("Applied program")
 
-    def _order_apply_reward(self, reward, coupon):
-        """
-        Applies the reward to the order provided the given coupon has enough points.
-        This method does not check for program rules.
+    def _get_reward_order_items(self, reward) -> List[OrderItem]:
+        return self.item_programs.items_for(reward.program_id)
+
+    @staticmethod
+    def _cycle_months(cycle) -> int:
+        return cycle.cycle_multiplier if cycle.cycle == 'month' else cycle.cycle_multiplier * 12
+
+    def _price_columns(self, order_items) -> Tuple[list, list, list]:
+        """Columns of the reward pricing: base price, cycle factor ``(item_months, service_months)``
+        and configurable options price deducted from the item.
         """
-        if reward.reward_type != RewardProgram.DISCOUNT:
-            return None
-        if reward.discount_applicability != RewardProgram.APPLY_ORDER:
-            return False
-        if not self.item_product_programs:
-            return False
-        order_items = list(map(
-                lambda item_program: item_program.item,
-                list(filter(
-                    lambda item_program: item_program.program == reward.program,
-                    self.item_programs
-                ))
-            )
-        ) # [{item, program}] = > [item]
-        total_discount = decimal.Decimal(reward.discount / len(order_items))
+        base_prices = []
+        cycle_factors = []
+        option_prices = []
         for item in order_items:
+            factor = (1, 1)
             if item.item_type == OrderItemTypes.service:
-                fixed_price = item.fixed_price
+                base_price = item.fixed_price
             elif item.item_type in OrderItemTypes.types_require_service:
                 if not item.service:
                     raise APIException('Item missing service.')
                 if item.item_type in [OrderItemTypes.serviceUpgrade, OrderItemTypes.serviceResize] or item.service.cycle.cycle == 'onetime':
-                    fixed_price = item.fixed_price
+                    base_price = item.fixed_price
                 else:
                     try:
-                        if item.service.cycle.cycle == item.cycle.cycle:
-                            fixed_price = item.service.get_fixed_price(override_price=False) / (item.service.cycle.cycle_multiplier) * decimal.Decimal(item.cycle.cycle_multiplier)
-                        else:
-                            fixed_price = item.service.get_fixed_price(override_price=False)
-                            if item.service.cycle.cycle == 'month':
-                                price_service_per_month = fixed_price / item.service.cycle.cycle_multiplier
-                            else:
-                                price_service_per_month = fixed_price / 12 / item.service.cycle.cycle_multiplier
-                            if item.cycle.cycle == 'month':
-                                fixed_price = price_service_per_month * item.cycle.cycle_multiplier
-                            else:
-                                fixed_price = price_service_per_month * item.cycle.cycle_multiplier * 12
+                        base_price = item.service.get_fixed_price(override_price=False)
+                        # giá dịch vụ quy đổi theo tháng rồi nhân với số tháng của chu kỳ item
+                        factor = (self._cycle_months(item.cycle), self._cycle_months(item.service.cycle))
                     except Exception as e:
                         raise APIException(str(e))
             else:
                 raise APIException(_('Unable get price'))
+            base_prices.append(base_price)
+            cycle_factors.append(factor)
+            option_prices.append(
+                Decimal(0) if item.item_type == OrderItemTypes.service else item.configurable_options_price
+            )
+        return base_prices, cycle_factors, option_prices
 
-            if reward.discount_mode == 'percent':
-                price = fixed_price * (1 - Decimal(reward.discount) / 100)
-                discount = reward.discount
-            else:
-                price = fixed_price - total_discount
-                discount = (total_discount / fixed_price) * 100
+    def _compute_reward_prices(self, reward, order_items) -> List[ItemRewardPrice]:
+        """Compute the discounted prices of ``order_items`` for ``reward`` without saving anything.
+
+        Prices are computed column by column for the whole item set. A fixed discount is split
+        proportionally to the item prices and the item discounts always sum to the reward.
+        """
+        base_prices, cycle_factors, option_column = self._price_columns(order_items)
+        fixed_prices = [
+            base_price if (item_months, service_months) == (1, 1)
+            else Decimal(base_price) / service_months * item_months
+            for base_price, (item_months, service_months) in zip(base_prices, cycle_factors)
+        ]
+        charged_prices = [
+            cdecimal(fixed_price - option_price, q=1)
+            for fixed_price, option_price in zip(fixed_prices, option_column)
+        ]
+        if reward.discount_mode == 'percent':
+            rate = 1 - Decimal(reward.discount) / 100
+            prices = [fixed_price * rate for fixed_price in fixed_prices]
+            totals = [
+                cdecimal(price - option_price, q=1) for price, option_price in zip(prices, option_column)
+            ]
+            discounts = [reward.discount] * len(order_items)
+        else:
+            allocations = allocate_amount(Decimal(str(reward.discount)), charged_prices)
+            prices = [fixed_price - allocation for fixed_price, allocation in zip(fixed_prices, allocations)]
+            totals = [charged - allocation for charged, allocation in zip(charged_prices, allocations)]
+            discounts = [
+                (allocation / fixed_price) * 100 if fixed_price else Decimal(0)
+                for allocation, fixed_price in zip(allocations, fixed_prices)
+            ]
+
+        item_prices = []
+        for item, price, charged, total, discount in zip(order_items, prices, charged_prices, totals, discounts):
+            option_prices = []
             if item.item_type == OrderItemTypes.service:
                 for configurable_options in item.configurable_options.all():
-                    option_cycle = configurable_options.option.cycles.first()
+                    option_cycle = self.graph.option_cycle(configurable_options.option)
                     if option_cycle.price_type == ConfigurableOptionCycle.PRICE_TYPES.percentage:
                         option_price = option_cycle.convert_price_type_percentage_to_base_price(price=price)
                     else:
                         option_price = option_cycle.price
-                    base_price = option_price * configurable_options.quantity
-                    configurable_options.price = base_price
-                    # configurable_options.unit_price = base_price
-                    configurable_options.save(update_fields=['price', 'unit_price'])
-            else:
-                price = price - item.configurable_options_price
-                fixed_price = fixed_price - item.configurable_options_price
-            item.fixed_price = cdecimal(fixed_price, q=1)
-            item.total = cdecimal(price, q=1)
-            item.discount = discount
-            item.program_reward = reward
-            item.order_point_reward = coupon
-            item.save(update_fields=['total', 'fixed_price', 'discount', 'program_reward', 'order_point_reward'])
-        # reset order item remains
-        order_item_remains = self.order_items.exclude(id__in=list(map(lambda item: item.id, order_items)))
-        if order_item_remains:
-            update_order_items(order_item_remains)
+                    option_prices.append((configurable_options, option_price * configurable_options.quantity))
+            item_prices.append(ItemRewardPrice(
+                item=item,
+                fixed_price=charged,
+                total=total,
+                discount=discount,
+                option_prices=option_prices,
+            ))
+        return item_prices
+
+    @instrumented('order_apply_reward')
+    @order_locked
+    def _order_apply_reward(self, reward, coupon):
+        """
+        Applies the reward to the order provided the given coupon has enough points.
+        This method does not check for program rules.
+        """
+        if reward.reward_type != RewardProgram.DISCOUNT:
+            return None
+        if reward.discount_applicability != RewardProgram.APPLY_ORDER:
+            return False
+        if not self.item_product_programs:
+            return False
+        order_items = self._get_reward_order_items(reward)
+        item_prices = self._compute_reward_prices(reward, order_items)
+        # giá item được hưởng reward và giá gốc của các item còn lại được ghi trong cùng transaction
+        with transaction.atomic():
+            save_reward_prices([(reward, coupon, item_prices)])
+            # reset order item remains
+            order_item_remains = self.order_items.exclude(id__in=list(map(lambda item: item.id, order_items)))
+            if order_item_remains:
+                update_order_items(order_item_remains)
+        self.invalidate_evaluation()
 
         return True
 
+    def _preview_claimable_rewards(self, programs_and_point: dict) -> dict:
+        """Same filtering as :meth:`_get_claimable_rewards` on computed points, without coupons.
+
+        Returns a dict ``{program: [reward, ...]}`` with rewards ordered by discount descending.
+        """
+        total_is_zero = cdecimal(self.total_order_amount, q="0.0001") < 1
+        rewards_by_program = self._get_rewards_by_program({program.id for program in programs_and_point})
+        result: dict = dict()
+        for program, data in programs_and_point.items():
+            result_rewards = self._filter_claimable_rewards(
+                rewards_by_program.get(program.id, []), data['points'], total_is_zero
+            )
+            if result_rewards:
+                result[program] = result_rewards
+        return result
+
+    def _preview_reward_error(self, reward: RewardProgram, programs_and_point: dict, claimable: dict) -> Optional[str]:
+        """Error :meth:`_order_try_apply_reward` would return for ``reward``, ``None`` when it applies."""
+        program = reward.program
+        catalog_program = self.catalog.get(program)
+        if catalog_program is None:
+            return _("Program not available")
+        if catalog_program.has_cards and not self.card_resolver().is_available(program):
+            return _("Program not available")
+        if not self.item_product_programs:
+            return _("Program not available")
+        if isinstance(programs_and_point, dict):
+            point_and_error = programs_and_point.get(program)
+            if not point_and_error:
+                return _("Program not available")
+            if 'error' in point_and_error:
+                return point_and_error.get("error", _("Program not available"))
+        if reward not in claimable.get(program, []):
+            return _("Program not available")
+        return None
+
+    def _preview_coupon_error(self, programs_and_point: dict, claimable: dict) -> Optional[str]:
+        """Error :meth:`_order_try_apply_coupon` would return, ``None`` when the coupon applies."""
+        if not self.item_product_programs or not programs_and_point:
+            return "No program available"
+        if isinstance(programs_and_point, dict):
+            point_and_error = programs_and_point.get(next(iter(programs_and_point)))
+            if 'error' in point_and_error:
+                return point_and_error.get("error")
+        if len(claimable) != 1:
+            return _("Can not apply coupon")
+        return None
+
+    def preview(self, code=None, reward: RewardProgram = None) -> dict:
+        """Dry-run evaluation of the order, performs no database write.
+
+        Computes the points of every applicable program, the claimable rewards and, for ``reward``
+        (or the largest reward of the coupon when ``code`` is given), the discounted item prices.
+        The reward or coupon goes through the same eligibility checks as :meth:`commit`, whose
+        refusal message is returned as ``error`` (without items). Use :meth:`commit` to persist
+        the same result.
+        """
+        # cùng thứ tự ưu tiên với commit: reward, rồi code, rồi promotion
+        if reward is None and code:
+            self.get_active_programs(code)
+            programs_and_point = self.evaluate_programs(code=code) if self.item_product_programs else dict()
+        else:
+            self.get_active_programs(code=None, program_type=ProgramTypes.promotion)
+            programs_and_point = self.evaluate_programs() if self.item_product_programs else dict()
+        claimable = self._preview_claimable_rewards(programs_and_point)
+
+        error = None
+        if reward is not None:
+            error = self._preview_reward_error(reward, programs_and_point, claimable)
+        elif code:
+            error = self._preview_coupon_error(programs_and_point, claimable)
+            if error is None:
+                reward = next(iter(claimable.values()))[0]
+        items = []
+        if (
+            error is None
+            and reward is not None
+            and reward.reward_type == RewardProgram.DISCOUNT
+            and reward.discount_applicability == RewardProgram.APPLY_ORDER
+        ):
+            order_items = self._get_reward_order_items(reward)
+            if order_items:
+                items = [item_price.as_dict() for item_price in self._compute_reward_prices(reward, order_items)]
+
+        return {
+            'catalog_version': self.catalog.version,
+            'programs': [
+                dict(program_id=program.id, **data) for program, data in programs_and_point.items()
+            ],
+            'claimable_rewards': [
+                {
+                    'program_id': program.id,
+                    'reward_id': claimable_reward.id,
+                    'required_point': claimable_reward.required_point,
+                    'discount': claimable_reward.discount,
+                    'discount_mode': claimable_reward.discount_mode,
+                }
+                for program, rewards in claimable.items() for claimable_reward in rewards
+            ],
+            'reward_id': reward.id if items else None,
+            'items': items,
+            'error': error,
+        }
+
+    def commit(self, code=None, reward: RewardProgram = None, idempotency_key: str = None):
+        """Persist the evaluation that :meth:`preview` computed for the same arguments.
+
+        With ``idempotency_key`` a retried or duplicated request (double click, parallel tabs)
+        returns the result of the first one instead of applying again.
+        """
+        if idempotency_key is None:
+            return self._commit(code=code, reward=reward)
+        key = '%s:%s:%s' % (LOYALTY_APPLY_IDEMPOTENCY_PREFIX, self.order.pk, idempotency_key)
+        # marker có TTL ngắn để worker bị chết giữa chừng không chặn các lần thử lại
+        if not cache.add(key, LOYALTY_APPLY_PENDING, timeout=LOYALTY_APPLY_PENDING_TIMEOUT):
+            result = cache.get(key, LOYALTY_APPLY_PENDING)
+            if result == LOYALTY_APPLY_PENDING:
+                return False, _("The request is being processed")
+            return result
+        try:
+            result = self._commit(code=code, reward=reward)
+        except Exception:
+            cache.delete(key)
+            raise
+        cache.set(key, self._cacheable_result(result), timeout=LOYALTY_APPLY_IDEMPOTENCY_TIMEOUT)
+        return result
+
+    @staticmethod
+    def _cacheable_result(result):
+        """``result`` of :meth:`_commit` in a form the cache can pickle, with lazy strings rendered."""
+        if isinstance(result, tuple):
+            return tuple(str(value) if isinstance(value, Promise) else value for value in result)
+        if isinstance(result, dict):
+            # {OrderPointReward: [RewardProgram, ...]} của promotion
+            return {coupon: list(rewards) for coupon, rewards in result.items()}
+        return result
+
+    def _commit(self, code=None, reward: RewardProgram = None):
+        if reward is not None:
+            return self._order_try_apply_reward(reward)
+        if code:
+            return self._order_try_apply_coupon(code)
+        return self._get_rewards_type_promotion()
+
     # def _get_reward_values_discount(self, reward: RewardProgram, coupon: OrderPointReward):
     #     """ The method returm data to create order item discount to the order
     #     """
@@ -355,6 +1800,133 @@ class OrderLoyaltyProgram:
     #                 break
     #     return total_order_amount
 
+    @property
+    def pricing_version(self) -> int:
+        if self._pricing_version is None:
+            self._pricing_version = pricing_generation.current()
+        return self._pricing_version
+
+    def _get_instance_traits(self, item: OrderItem):
+        """Simulated instance traits, cached by configuration and pricing catalog version."""
+        plugin_data = item.plugin_data
+        configuration = dict(
+            vcpus=plugin_data.get('vcpus'),
+            region=plugin_data.get('region_name'),
+            root_gb=plugin_data.get('disk'),
+            memory_mb=plugin_data.get('ram'),
+            instance_type=plugin_data.get('flavor_name'),
+            aggregate_instance=plugin_data.get('aggregate_instance'),
+        )
+        return instance_traits_cache.get_or_compute(
+            (self.pricing_version, _freeze(configuration)),
+            lambda: PriceSimulatorUtils.get_customize_instance_simulated_traits(**configuration),
+        )
+
+    def _get_item_trait_matches(self, item: OrderItem) -> tuple:
+        if item.id not in self._item_traits:
+            traits = self._get_instance_traits(item)
+            matcher = self.catalog.condition_matcher
+            self._item_traits[item.id] = (
+                traits, matcher.match(traits) if isinstance(traits, dict) else None
+            )
+        return self._item_traits[item.id]
+
+    def remaining_usage(self, program: LoyaltyProgram) -> int:
+        """Remaining usage of a limited program for the order user, read once per evaluator."""
+        if program.id not in self._remaining_usage:
+            self._remaining_usage[program.id] = program.remaining_quantity(self.user)
+        return self._remaining_usage[program.id]
+
+    def _get_matching_conditions(self, item: OrderItem, program: LoyaltyProgram):
+        """Trait conditions of ``program`` matched by an instance item.
+
+        The traits and the compiled match of every program are computed once per item.
+        """
+        traits, matches = self._get_item_trait_matches(item)
+        if matches is None or program.id in self.catalog.condition_matcher.fallback_program_ids:
+            return program.get_all_matching_reward_conditions(traits)
+        return matches.get(program.id, [])
+
+    def _evaluate_item_program(self, ipp: OrderItemProductProgram, program: LoyaltyProgram, code=None) -> Optional[dict]:
+        """Points and error of ``program`` for one item, ``None`` when the program is skipped."""
+        if code and not self.card_resolver(code).is_available(program, code=code):
+            return None
+        if not program.unlimited and self.remaining_usage(program) < 1:
+            return None
+        conditions = self.catalog.conditions(program)
+
+        matched = bool(conditions) and program.applies_on == 'current'
+        minimum_amount_matched = matched
+        count_minimum_amount_matched = 0
+        minimum_quantity_matched = matched
+        # order_type_matched = matched
+        count_order_type_matched = 0
+        if program.is_has_math_condition:
+            product = ipp.product
+            if product.product_type == ReosurceTypes.instance:
+                if not isinstance(ipp.item.plugin_data, dict):
+                    return None
+                conditions = self._get_matching_conditions(ipp.item, program)
+            else:
+                # TODO: handler for anthor product (proxy, domain, ssl, ...)
+                pass
+        points = 0
+
+        for condition in conditions:
+            # Check minimum amount order
+            condition_minimum_amount = condition.get_minimun_amount(currency=self.currency)
+            if condition_minimum_amount > self.total_amount:
+                # TODO: handler the case condition include tax or exclude tax
+                minimum_amount_matched = False
+                continue
+            else:
+                minimum_amount_matched = True
+                count_minimum_amount_matched += 1
+            # TODO: Handler minimum quantity
+            minimum_quantity_matched = True
+
+            if program.applies_on == 'future':
+                # TODO: handler program appies on future
+                continue
+            else:
+                if condition.reward_point_mode == 'order':
+                    # TODO: handler for another case
+                    cycle_ids = self.catalog.condition_cycle_ids(program, condition)
+                    if cycle_ids and ipp.item.cycle_id not in cycle_ids:
+                        continue
+                    item_type = OrderItemTypes.service if self.is_one_time(ipp.item) else ipp.item.item_type
+                    if condition.order_item_type and item_type != condition.order_item_type:
+                        continue
+                    else:
+                        if not self.item_programs.contains(ipp.item, program):
+                            total_order_item = self.totals.subtotal(item_type)
+                            if self.is_one_time(ipp.item):
+                                total_order_item += self.totals.subtotal(ipp.item.item_type)
+                            if total_order_item < condition_minimum_amount:
+                                minimum_amount_matched = False
+                                continue
+                            minimum_amount_matched = True
+                            self.item_programs.add(ipp.item, program)
+
+                        count_order_type_matched += 1
+                        points += condition.reward_point_amount
+        program_result: dict = dict(points=points)
+        if not matched:
+            program_result['error'] = _("Can not apply program.")
+        elif not minimum_amount_matched:
+            program_result['error'] = _(
+                'A minimum of %(amount)s %(code)s should be purchased to get the reward'
+            ) % {
+                'amount': min(condition.minimum_amount for condition in conditions),
+                 'code': self.currency.code
+            }
+        elif not minimum_quantity_matched:
+            program_result['error'] = _("Can not apply program.")
+        elif count_order_type_matched == 0:
+            program_result['error'] = _("Can not apply program.")
+        return program_result
+
+    @instrumented('order_program_check_compute_points')
     def _order_program_check_compute_points(self, code=None):
         """
         Checks the program validity from the order items aswell as computing the number of points to add.
@@ -364,98 +1936,10 @@ class OrderLoyaltyProgram:
         result = dict()
         for ipp in self.item_product_programs:
             for program in ipp.programs:
-                if code and not program.loyalty_cards.filter(code=code).filter(
-                    Q(expiration_time__isnull=True) |
-                    Q(expiration_time__gt=timezone.now())
-                ).filter(Q(partner=self.user) | Q(partner__isnull=True)).exists():
+                with loyalty_instrumentation.stage('evaluate_program', order_id=self.order.pk, program_id=program.id):
+                    program_result = self._evaluate_item_program(ipp, program, code=code)
+                if program_result is None:
                     continue
-                if not program.unlimited and program.remaining_quantity(self.user) < 1:
-                    continue
-                conditions: "QuerySet[ProgramCondition]" = program.program_conditions.active()
-                
-                matched = conditions.exists() and program.applies_on == 'current'
-                minimum_amount_matched = matched
-                count_minimum_amount_matched = 0
-                minimum_quantity_matched = matched
-                # order_type_matched = matched
-                count_order_type_matched = 0
-                if program.is_has_math_condition:
-                    product = ipp.product
-                    if product.product_type == ReosurceTypes.instance:
-                        plugin_data = ipp.item.plugin_data
-                        if isinstance(plugin_data, dict):
-                            traits = PriceSimulatorUtils.get_customize_instance_simulated_traits(
-                                    vcpus=plugin_data.get('vcpus'),
-                                    region=plugin_data.get('region_name'),
-                                    root_gb=plugin_data.get('disk'),
-                                    memory_mb=plugin_data.get('ram'),
-                                    instance_type=plugin_data.get('flavor_name'),
-                                    aggregate_instance=plugin_data.get('aggregate_instance'),
-                            )
-                            conditions = program.get_all_matching_reward_conditions(traits)
-                        else:
-                            continue
-                    else:
-                        # TODO: handler for anthor product (proxy, domain, ssl, ...)
-                        pass
-                points = 0
-
-                for condition in conditions:
-                    # Check minimum amount order
-                    condition_minimum_amount = condition.get_minimun_amount(currency=self.currency)
-                    if condition_minimum_amount > self.total_amount:
-                        # TODO: handler the case condition include tax or exclude tax
-                        minimum_amount_matched = False
-                        continue
-                    else:
-                        minimum_amount_matched = True
-                        count_minimum_amount_matched += 1
-                    # TODO: Handler minimum quantity
-                    minimum_quantity_matched = True
-
-                    if program.applies_on == 'future':
-                        # TODO: handler program appies on future
-                        continue
-                    else:
-                        if condition.reward_point_mode == 'order':
-                            # TODO: handler for another case
-                            if condition.product_cycles.exists() and not condition.product_cycles.filter(id=ipp.item.cycle.id).exists():
-                                continue
-                            item_type = OrderItemTypes.service if self.is_one_time(ipp.item) else ipp.item.item_type
-                            if condition.order_item_type and item_type != condition.order_item_type:
-                                continue
-                            else:
-                                if not list(filter(
-                                    lambda
-                                        item_program: item_program.item == ipp.item and item_program.program == program,
-                                        self.item_programs
-                                )):
-                                    total_order_item = self.order_items.filter(item_type=item_type).total_origin()
-                                    if self.is_one_time(ipp.item):
-                                        total_order_item += self.order_items.filter(item_type=ipp.item.item_type).total_origin()
-                                    if total_order_item < condition_minimum_amount:
-                                        minimum_amount_matched = False
-                                        continue
-                                    minimum_amount_matched = True
-                                    self.item_programs.append(ItemProgram(item=ipp.item, program=program))
-
-                                count_order_type_matched += 1
-                                points += condition.reward_point_amount
-                program_result: dict = dict(points=points)
-                if not matched:
-                    program_result['error'] = _("Can not apply program.")
-                elif not minimum_amount_matched:
-                    program_result['error'] = _(
-                        'A minimum of %(amount)s %(code)s should be purchased to get the reward'
-                    ) % {
-                        'amount': min(conditions.values_list('minimum_amount', flat=True)),
-                         'code': self.currency.code
-                    }
-                elif not minimum_quantity_matched:
-                    program_result['error'] = _("Can not apply program.")
-                elif count_order_type_matched == 0:
-                    program_result['error'] = _("Can not apply program.")
-
                 if program in result:
                     if 'error' in result[program]:
                         result[program] = program_result
@@ -464,61 +1948,322 @@ class OrderLoyaltyProgram:
         return result
 
 
-    def get_programs(self) -> list:
+    def _program_rewards(self) -> Tuple[Tuple[int, ...], Tuple[RewardProgram, ...]]:
+        """Rewards of the promotion programs available to the order, unique and sorted by id."""
         self.get_active_programs(None, ProgramTypes.promotion)
-        rewards = []
+        rewards: Dict[int, RewardProgram] = dict()
+        program_ids = set()
         for item in self.item_product_programs:
             for program in item.programs:
+                if program.id in program_ids:
+                    continue
+                program_ids.add(program.id)
                 if (
-                    program.loyalty_cards.filter(code__isnull=False).exists() 
-                    and not program.loyalty_cards.filter(
-                        Q(expiration_time__isnull=True)
-                        | Q(expiration_time__gt=timezone.now())
-                    ).filter(Q(partner=self.user) | Q(partner__isnull=True)).exists()
+                    self.catalog.get(program).has_code_cards
+                    and not self.card_resolver().is_available(program)
                 ):
                     continue
-                rewards = list(set(rewards + list(program.program_rewards.all())))
-        rewards_data = []
-        for reward in rewards:
-            serializer_data_reward: dict = dict(
-                **RewardProgramClientSerializer(reward).data,
-                can_apply=True,
-                remain_usage=-1
-            )
-            total_is_zero = cdecimal(self.total_order_amount, q="0.0001") < 1
+                for reward in self.catalog.rewards(program):
+                    rewards.setdefault(reward.id, reward)
+        reward_ids = tuple(sorted(rewards))
+        return reward_ids, tuple(rewards[reward_id] for reward_id in reward_ids)
+
+    def iter_rewards(self, after: int = None) -> Iterator[dict]:
+        """Yield the serialized rewards of :meth:`get_programs` by increasing id.
+
+        Rewards are filtered before they are serialized, so consuming the first ``n`` items only
+        serializes those. ``after`` is a reward id, listing resumes right after it.
+        """
+        for _reward, serializer_data_reward in self._iter_reward_data(after):
+            yield serializer_data_reward
+
+    def _iter_reward_data(self, after: int = None) -> Iterator[Tuple[RewardProgram, dict]]:
+        reward_ids, rewards = self._program_rewards()
+        start = bisect.bisect_right(reward_ids, after) if after is not None else 0
+        programs_and_point = self.evaluate_programs()
+        if start >= len(rewards) or not isinstance(programs_and_point, dict):
+            return
+        total_is_zero = cdecimal(self.total_order_amount, q="0.0001") < 1
+        for reward in rewards[start:]:
             if reward.reward_type == RewardProgram.DISCOUNT and total_is_zero:
                 continue
+            remain_usage = -1
             if not reward.program.unlimited:
                 remain_usage = reward._remain_quantity(self.user)
-                serializer_data_reward.update(remain_usage=remain_usage)
                 if remain_usage < 1:
                     continue
-            programs_and_point = self._order_program_check_compute_points()
-            if not isinstance(programs_and_point, dict):
-                continue
+            serializer_data_reward: dict = dict(
+                self.catalog.serialized_reward(reward),
+                can_apply=True,
+                remain_usage=remain_usage,
+            )
             point_and_error = programs_and_point.get(reward.program)  # {program: {'points': number, 'error': str}} => {'points': number, 'error': str}
             if not point_and_error:
                 serializer_data_reward.update(
                     can_apply=False,
                     messages_error=_("Can not apply program."),
                 )
-                rewards_data.append(serializer_data_reward)
-                continue
-            if 'error' in point_and_error:
+            elif 'error' in point_and_error:
                 serializer_data_reward.update(
                     can_apply=False,
                     messages_error=point_and_error.get("error"),
                 )
-                rewards_data.append(serializer_data_reward)
-                continue
-
-            if reward.required_point > int(point_and_error.get("points")):
+            elif reward.required_point > int(point_and_error.get("points")):
                 serializer_data_reward.update(
                     can_apply=False,
                     messages_error=_("You are not eligible"),
                 )
-                rewards_data.append(serializer_data_reward)
-                continue
-            rewards_data.append(serializer_data_reward)
+            yield reward, serializer_data_reward
+
+    def list_programs(self, cursor: int = None, limit: int = LOYALTY_REWARD_PAGE_SIZE) -> dict:
+        """One page of :meth:`iter_rewards`; pass ``next_cursor`` back as ``cursor`` for the next page."""
+        page = list(itertools.islice(self._iter_reward_data(after=cursor), limit + 1))
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = page[-1][0].id
+        return {
+            'results': [serializer_data_reward for _reward, serializer_data_reward in page],
+            'next_cursor': next_cursor,
+        }
+
+    def get_programs(self) -> list:
+        return list(self.iter_rewards())
+
+    # Async API: các dependency độc lập được nạp song song trên thread pool,
+    # sau đó phần đánh giá chạy trên dữ liệu đã nạp với cùng kết quả như API đồng bộ
+
+    @classmethod
+    async def acreate(cls, order: Order, catalog: LoyaltyCatalogSnapshot = None) -> 'OrderLoyaltyProgram':
+        if catalog is None:
+            catalog = await sync_to_async(get_loyalty_catalog, thread_sensitive=False)()
+        return await sync_to_async(cls, thread_sensitive=False)(order, catalog)
+
+    @staticmethod
+    def _run_async(func, *args, **kwargs):
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # thread của executor không nhận request_started/request_finished; connection được giữ
+                # lại để dùng cho lần sau (không đóng theo CONN_MAX_AGE như close_old_connections)
+                # và chỉ bị đóng khi đã hỏng
+                if connection.errors_occurred:
+                    if connection.is_usable():
+                        connection.errors_occurred = False
+                    else:
+                        connection.close()
+        return sync_to_async(run, thread_sensitive=False)()
+
+    @staticmethod
+    def _prepare_scope(code=None, reward: RewardProgram = None) -> dict:
+        """Active programs read by :meth:`preview` / :meth:`commit`: reward, then code, then promotion."""
+        if reward is None and code:
+            return dict(code=code, program_type=None)
+        return dict(code=None, program_type=ProgramTypes.promotion)
+
+    def _warm_item_traits(self):
+        for ipp in self.item_product_programs:
+            if ipp.product.product_type == ReosurceTypes.instance and isinstance(ipp.item.plugin_data, dict):
+                self._get_item_trait_matches(ipp.item)
+
+    def _warm_remaining_usage(self):
+        for ipp in self.item_product_programs:
+            for program in ipp.programs:
+                if not program.unlimited:
+                    self.remaining_usage(program)
+
+    async def _aprepare(self, code=None, program_type: str = None):
+        """Load the evaluation dependencies concurrently, stage by stage of their dependency chain."""
+        await asyncio.gather(
+            self._run_async(lambda: self.graph),
+            self._run_async(lambda: self.user),
+        )
+        await asyncio.gather(
+            self._run_async(self.get_active_programs, code=code, program_type=program_type),
+            self._run_async(self.card_resolver, code),
+            self._run_async(lambda: self.totals),
+        )
+        await asyncio.gather(
+            self._run_async(self._warm_item_traits),
+            self._run_async(self._warm_remaining_usage),
+        )
+
+    async def aget_programs(self) -> list:
+        await self._aprepare(code=None, program_type=ProgramTypes.promotion)
+        return await self._run_async(self.get_programs)
+
+    async def alist_programs(self, cursor: int = None, limit: int = LOYALTY_REWARD_PAGE_SIZE) -> dict:
+        await self._aprepare(code=None, program_type=ProgramTypes.promotion)
+        return await self._run_async(self.list_programs, cursor=cursor, limit=limit)
+
+    async def apreview(self, code=None, reward: RewardProgram = None) -> dict:
+        await self._aprepare(**self._prepare_scope(code=code, reward=reward))
+        return await self._run_async(self.preview, code=code, reward=reward)
+
+    async def acommit(self, code=None, reward: RewardProgram = None, idempotency_key: str = None):
+        await self._aprepare(**self._prepare_scope(code=code, reward=reward))
+        # ghi dữ liệu trên thread đồng bộ của request để giữ nguyên transaction
+        return await sync_to_async(self.commit, thread_sensitive=True)(
+            code=code, reward=reward, idempotency_key=idempotency_key
+        )
+
+
+def order_graph_queryset(order_ids) -> "QuerySet[Order]":
+    """Orders with the items, services, cycles and configurable options read by the evaluator."""
+    return Order.objects.filter(pk__in=order_ids).select_related(
+        'client', 'currency'
+    ).prefetch_related(
+        Prefetch('items', queryset=order_items_graph_queryset()),
+    )
+
+
+class BatchOrderEvaluator:
+    """Re-evaluate the promotions of many orders, e.g. after a campaign launch or edit.
+
+    Orders are streamed by chunks of ``chunk_size``: each chunk is loaded with its full item graph,
+    evaluated against one shared catalog snapshot, then its OrderPointReward rows and the prices of
+    items holding a reward are written back in bulk. With ``processes`` the chunks are spread over
+    a forked process pool sharing the same snapshot; it cannot run inside ``transaction.atomic()``.
+    """
+
+    def __init__(self, chunk_size: int = LOYALTY_BATCH_CHUNK_SIZE, processes: int = None,
+                 catalog: LoyaltyCatalogSnapshot = None):
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self._catalog = catalog
+
+    @property
+    def catalog(self) -> LoyaltyCatalogSnapshot:
+        if self._catalog is None:
+            self._catalog = get_loyalty_catalog()
+        return self._catalog
+
+    def _chunks(self, orders):
+        if isinstance(orders, QuerySet):
+            order_ids = orders.values_list('pk', flat=True).iterator(chunk_size=self.chunk_size)
+        else:
+            order_ids = (getattr(order, 'pk', order) for order in orders)
+        while True:
+            chunk = list(itertools.islice(order_ids, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def evaluate_chunk(self, order_ids) -> dict:
+        with transaction.atomic():
+            return self._evaluate_locked_chunk(order_ids)
+
+    @staticmethod
+    def _first_user(client):
+        """``client.users.first()`` served from the prefetched users."""
+        users = list(client.users.all())
+        if not users:
+            return None
+        if client.users.model._meta.ordering:
+            return users[0]
+        return min(users, key=lambda user: user.pk)
+
+    def _evaluate_locked_chunk(self, order_ids) -> dict:
+        point_entries = []
+        assignments = []
+        reset_item_ids = []
+        # khóa các order của chunk như order_locked để không chạy song song với request apply,
+        # theo thứ tự pk để hai lượt batch chồng lên nhau không deadlock
+        orders = list(
+            order_graph_queryset(order_ids).prefetch_related(
+                'client__users'
+            ).select_for_update(of=('self',)).order_by('pk')
+        )
+        # user, thẻ và số lượt còn lại được nạp một lần cho cả chunk thay vì theo từng order
+        users = {order.pk: self._first_user(order.client) for order in orders}
+        card_resolvers = LoyaltyCardResolver.for_users(
+            users.values(), [entry.program.id for entry in self.catalog.programs if entry.has_cards]
+        )
+        remaining_usage: Dict[Optional[int], Dict[int, int]] = dict()
+        for order in orders:
+            evaluator = OrderLoyaltyProgram(order, catalog=self.catalog)
+            user_id = getattr(users[order.pk], 'pk', None)
+            evaluator.preload(
+                users[order.pk], card_resolver=card_resolvers[user_id],
+                remaining_usage=remaining_usage.setdefault(user_id, dict()),
+            )
+            evaluator.get_active_programs(code=None, program_type=ProgramTypes.promotion)
+            programs_and_point = evaluator.evaluate_programs() if evaluator.item_product_programs else dict()
+            point_entries.extend(
+                (order, order.client, program, data['points']) for program, data in programs_and_point.items()
+            )
+            claimable = evaluator._preview_claimable_rewards(programs_and_point)
+            for reward_id in {item.program_reward_id for item in evaluator.item_list if item.program_reward_id}:
+                rewarded_items = [item for item in evaluator.item_list if item.program_reward_id == reward_id]
+                reward = self.catalog.reward(reward_id)
+                order_items = []
+                if (
+                    reward is not None
+                    and reward in claimable.get(reward.program, [])
+                    and reward.reward_type == RewardProgram.DISCOUNT
+                    and reward.discount_applicability == RewardProgram.APPLY_ORDER
+                ):
+                    order_items = evaluator._get_reward_order_items(reward)
+                if order_items:
+                    assignments.append((order, reward, evaluator._compute_reward_prices(reward, order_items)))
+                # item không còn được hưởng reward thì tính lại giá gốc
+                reset_item_ids.extend(item.id for item in rewarded_items if item not in order_items)
+
+        coupons = upsert_order_point_rewards(point_entries)
+        coupon_by_program = {(coupon.order_id, coupon.program_id): coupon for coupon in coupons}
+        updated_items = save_reward_prices([
+            (reward, coupon_by_program.get((order.pk, reward.program_id)), item_prices)
+            for order, reward, item_prices in assignments
+        ])
+        if reset_item_ids:
+            update_order_items(OrderItem.objects.filter(id__in=reset_item_ids))
+        return {
+            'orders': len(orders),
+            'order_point_rewards': len(coupons),
+            'items': updated_items,
+            'reset_items': len(reset_item_ids),
+        }
+
+    def run(self, orders) -> dict:
+        """Evaluate ``orders`` (a queryset or an iterable of orders or ids), returns the totals written."""
+        result = dict(orders=0, order_point_rewards=0, items=0, reset_items=0)
+        if self.processes and self.processes > 1:
+            if connection.in_atomic_block:
+                # close_all() trước khi fork sẽ phá transaction của caller
+                raise RuntimeError('BatchOrderEvaluator cannot use a process pool inside transaction.atomic()')
+            # snapshot và danh sách id được nạp trước khi fork, process con tự mở connection
+            self.catalog
+            chunks = list(self._chunks(orders))
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=self.processes, mp_context=multiprocessing.get_context('fork'),
+                # với fork, evaluator (cùng snapshot và chunk_size) được kế thừa, không bị pickle
+                initializer=_init_order_chunk_worker, initargs=(self,),
+            ) as pool:
+                chunk_results = pool.map(_evaluate_order_chunk, chunks)
+                for chunk_result in chunk_results:
+                    for key, value in chunk_result.items():
+                        result[key] += value
+            return result
+        for chunk in self._chunks(orders):
+            for key, value in self.evaluate_chunk(chunk).items():
+                result[key] += value
+        return result
+
+
+_worker_evaluator: Optional[BatchOrderEvaluator] = None
+
+
+def _init_order_chunk_worker(evaluator: BatchOrderEvaluator):
+    global _worker_evaluator
+    _worker_evaluator = evaluator
+
+
+def _evaluate_order_chunk(order_ids) -> dict:
+    return _worker_evaluator.evaluate_chunk(order_ids)
+
 
-        return rewards_data
+def evaluate_orders(orders, chunk_size: int = LOYALTY_BATCH_CHUNK_SIZE, processes: int = None) -> dict:
+    """Batch entry point to re-price every order of ``orders`` against the current catalog."""
+    return BatchOrderEvaluator(chunk_size=chunk_size, processes=processes).run(orders)